@@ -9,20 +9,51 @@ Original file is located at
 
 !pip install torch torchvision torchaudio
 !pip install transformers
+!pip install pyarrow
+!pip install onnx onnxruntime
 
 pip install optuna
 
-from google.colab import drive
+try:
+    from google.colab import drive
+except ImportError:
+    # Outside Colab, e.g. for the offline benchmark suite, which never mounts Drive
+    drive = None
 import pandas as pd
 import numpy as np
 import torch
-from transformers import BertTokenizer, BertForSequenceClassification, AdamW
-from sklearn.metrics import classification_report
-from sklearn.model_selection import train_test_split
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
+import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from transformers import BertTokenizer, BertTokenizerFast, BertForSequenceClassification, BertConfig, AdamW
+from transformers.modeling_outputs import SequenceClassifierOutput
+from sklearn.metrics import classification_report, accuracy_score
+from sklearn.model_selection import train_test_split, GroupShuffleSplit
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 import optuna
 from joblib import dump
+import joblib
 import warnings
 import re
+import os
+import glob
+import shutil
+import json
+import hashlib
+import multiprocessing
+import time
+import copy
+import contextlib
+import asyncio
+import threading
+import concurrent.futures
+import urllib.request
+import fcntl
+import subprocess
+import tempfile
+import sys
 
 # Ignore warnings
 warnings.filterwarnings('ignore')
@@ -30,46 +61,1778 @@ warnings.filterwarnings('ignore')
 # Define global variables for X_train, y_train, X_val, and y_val
 X_train, y_train, X_val, y_val = None, None, None, None
 
-def load_data():
-    # Mount Google Drive
-    drive.mount('/content/drive')
-
-    # Load the DataFrames
-    folder_path = '/content/drive/My Drive/Hs/'
+# Converted tables and other cached artifacts are kept next to the source files
+CACHE_DIR = '/content/drive/My Drive/Hs/cache/'
+
+# Build the cohort by streaming diagnoses_icd in partitions instead of joining the full tables at once
+CHUNKED_JOIN = False
+JOIN_MEMORY_LIMIT_MB = 4096
+
+# Bytes of csv parsed at a time when converting a MIMIC-IV table to Parquet
+CSV_BLOCK_BYTES = 64 * 2**20
+
+# Run the optional timing/memory comparisons alongside the main pipeline
+RUN_BENCHMARKS = False
+
+# Run the offline benchmark suite on synthetic data instead of the pipeline (also set by --benchmark-suite)
+RUN_BENCHMARK_SUITE = False
+
+# Local directory for the synthetic MIMIC-IV tables, the tiny BERT and the caches used by run_benchmark_suite,
+# and the file its results are appended to (one line per run, tagged with the git commit); a phase taking
+# more than BENCHMARK_TOLERANCE times as long as at the previously recorded commit is reported as a regression
+BENCHMARK_DIR = 'benchmarks/'
+BENCHMARK_RESULTS = 'benchmark_results.jsonl'
+BENCHMARK_TOLERANCE = 1.25
+
+# Threads used by the Rust-backed fast tokenizers for batch encoding, at most one per core the process
+# may run on (None: one per core). TOKENIZERS_PARALLELISM is deliberately left unset: a forked process
+# inherits its parent's thread pool without the threads, so when the parent has already batch-encoded,
+# tokenizers must be free to turn parallelism off in the child, which would otherwise hang
+TOKENIZER_WORKERS = None
+
+def set_tokenizer_threads(cores=None):
+    # The thread pool is created on the first batch encode of a process and keeps its size from then on;
+    # a forked study worker only gets a pool of its own when the parent had not encoded before the fork
+    cores = len(cores if cores is not None else os.sched_getaffinity(0))
+    os.environ['RAYON_RS_NUM_CPUS'] = str(min(TOKENIZER_WORKERS or cores, cores))
+
+set_tokenizer_threads()
+
+# Pruner used to stop unpromising trials from their per-epoch validation accuracy:
+# 'median', 'successive_halving', 'hyperband' or None
+PRUNER = 'median'
+
+# Optuna studies are journaled next to the cache so they survive kernel restarts and can be resumed;
+# STUDY_WORKERS processes share the journal, each pinned to its own slice of the CPU cores
+STUDY_DIR = CACHE_DIR + 'studies/'
+STUDY_WORKERS = 1
+
+# Trials save the weights they finish with so the final fit can warm-start from the best one; only the
+# CHECKPOINT_TOP_K best trials of each study are kept on disk (0 turns checkpointing off)
+CHECKPOINT_TOP_K = 3
+CHECKPOINT_DIR = STUDY_DIR + 'checkpoints/'
+
+# Wall time, throughput and peak RSS of the pipeline phases (data loading, tokenization, forward, backward,
+# optimizer step, evaluation, prediction) are appended to the PROFILE_TIMELINE JSONL file in the study
+# directory (STUDY_DIR outside a study) and the phase totals of every trial are attached to it as user
+# attributes; the trial numbered PROFILE_TRACE_TRIAL of each study is also recorded with the torch profiler
+# (None turns tracing off)
+PROFILE_PHASES = True
+PROFILE_TIMELINE = 'timeline.jsonl'
+PROFILE_TRACE_TRIAL = None
+
+# Epochs the final fit continues for on train+validation data when it starts from a trial checkpoint
+WARM_START_EPOCHS = 1
+
+# Screen hyperparameters with the classifiers training only the top layers on cached encoder features:
+# None fine-tunes the whole model, 0 trains the head on pooled embeddings, k > 0 also tunes the top k layers
+SEARCH_TRAINABLE_LAYERS = None
+
+# Train the classifiers on unique (text, label) pairs weighted by how often they occur, in the search and
+# in the final fits alike, so the tuned lr and epochs apply to the same number of optimizer steps per epoch
+SEARCH_DEDUPLICATE = False
+
+# Layout version of the model artifacts written by save_artifact
+ARTIFACT_VERSION = 1
+
+# Classifier parameters that only hold on the machine that trained it (its token cache and the trial
+# checkpoint it started from, which checkpoint pruning may delete), so they are not saved with it
+LOCAL_PARAMS = ('cache_dir', 'warm_start')
+
+# Rows of a DataFrame tokenized and scored at a time by BERTClassifier.predict_stream
+PREDICT_CHUNK_ROWS = 50000
+
+# Micro-batching of the local prediction server: the largest batch it scores at once, and how long the
+# first request of a batch may wait for others to join it
+SERVER_MAX_BATCH_SIZE = 64
+SERVER_MAX_WAIT_MS = 10
+
+# Background processes preparing batches for the bert-base-uncased DataLoader pipeline
+DATALOADER_WORKERS = 2
+
+# Training precision ('fp32', or 'bf16' to autocast forward passes to bfloat16 on CPU) and the number of
+# micro-batches each optimizer step accumulates gradients over, so the effective batch size stays the
+# searched one while only a micro-batch of activations is held in memory at a time
+TRAIN_PRECISION = 'fp32'
+ACCUMULATION_STEPS = 1
+
+# Column whose values never straddle the train/validation/test split (every row of a patient lands in the
+# same split), the split fractions and the seed of the persisted split
+SPLIT_GROUP_COLUMN = 'subject_id'
+SPLIT_TEST_SIZE = 0.1
+SPLIT_VAL_SIZE = 0.1
+SPLIT_SEED = 42
+
+# Backbones the BERTClassifier engine is run with, by short name
+BACKBONES = {
+    'bert-base-uncased': 'bert-base-uncased',
+    'clinicalbert': 'emilyalsentzer/Bio_ClinicalBERT',
+    'medbert': 'microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract',
+    'biobert': 'dmis-lab/biobert-v1.1',
+}
+
+# Vocabularies the fast tokenizers are checked against the pure-Python BertTokenizer for
+TOKENIZER_PARITY_MODELS = list(BACKBONES.values())
+
+# Explicit dtypes for the MIMIC-IV columns; low-cardinality strings are stored as categoricals
+MIMIC_DTYPES = {
+    'admissions': {'subject_id': 'int32', 'hadm_id': 'int32', 'admission_type': 'category',
+                   'admit_provider_id': 'category', 'admission_location': 'category',
+                   'discharge_location': 'category', 'insurance': 'category', 'language': 'category',
+                   'marital_status': 'category', 'race': 'category', 'ETHNICITY': 'category',
+                   'hospital_expire_flag': 'int8'},
+    'patients': {'subject_id': 'int32', 'gender': 'category', 'anchor_age': 'int16',
+                 'anchor_year': 'int16', 'anchor_year_group': 'category'},
+    'icustays': {'subject_id': 'int32', 'hadm_id': 'int32', 'stay_id': 'int32',
+                 'first_careunit': 'category', 'last_careunit': 'category', 'los': 'float64'},
+    'diagnoses_icd': {'subject_id': 'int32', 'hadm_id': 'int32', 'seq_num': 'int16',
+                      'icd_code': 'str', 'icd_version': 'int8'},
+    'd_icd_diagnoses': {'icd_code': 'str', 'icd_version': 'int8', 'long_title': 'str'},
+}
+
+def file_fingerprint(path, cache_dir=CACHE_DIR):
+    # Hashing multi-GB csv files on every run would defeat the cache, so the content
+    # hash is remembered against the file's size and modification time
+    stat = os.stat(path)
+    index_path = os.path.join(cache_dir, 'fingerprints.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    entry = index.get(path)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    return index[path]['sha256']
+
+def convert_table(folder_path, name, cache_dir=CACHE_DIR):
+    # Convert a MIMIC-IV csv into a typed Parquet file once per version of the source file
+    os.makedirs(cache_dir, exist_ok=True)
+    csv_path = folder_path + name + '.csv'
+    parquet_path = os.path.join(cache_dir, '{}-{}.parquet'.format(name, file_fingerprint(csv_path, cache_dir)[:16]))
+    if os.path.exists(parquet_path):
+        return parquet_path
+
+    # Stream the csv in blocks so that converting even diagnoses_icd stays within a bounded amount of
+    # memory; columns without an explicit dtype take the type pandas infers from the first rows, and
+    # columns that are empty there are read as strings
+    sample = pd.read_csv(csv_path, nrows=10000)
+    dtypes = MIMIC_DTYPES.get(name, {})
+    column_types = {}
+    for col in sample.columns:
+        dtype = dtypes.get(col)
+        if dtype == 'category':
+            column_types[col] = pa.dictionary(pa.int32(), pa.string())
+        elif dtype == 'str' or (dtype is None and (sample[col].dtype.kind not in 'biuf' or sample[col].isna().all())):
+            column_types[col] = pa.string()
+        else:
+            column_types[col] = pa.from_numpy_dtype(np.dtype(dtype if dtype is not None else sample[col].dtype))
+    reader = pacsv.open_csv(csv_path, read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_BYTES),
+                            convert_options=pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=True))
+
+    # Write under a temporary name so an interrupted conversion never leaves a truncated file
+    with pq.ParquetWriter(parquet_path + '.tmp', reader.schema) as writer:
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch]))
+    os.replace(parquet_path + '.tmp', parquet_path)
+
+    # Remove conversions of older versions of the same csv
+    for stale_path in glob.glob(os.path.join(cache_dir, name + '-*.parquet')):
+        if stale_path != parquet_path:
+            os.remove(stale_path)
+    return parquet_path
+
+def load_table(folder_path, name, exclude=(), cache_dir=CACHE_DIR):
+    # Load a MIMIC-IV table from its Parquet conversion, reading only the columns that are needed
+    parquet_path = convert_table(folder_path, name, cache_dir)
+    columns = [col for col in pq.read_schema(parquet_path).names if col not in exclude]
+    return pd.read_parquet(parquet_path, columns=columns)
+
+# Bump whenever build_cohort changes in a way that alters its output
+COHORT_VERSION = 1
+
+def function_fingerprint(function):
+    # Identify a function by its compiled body so that editing it invalidates cached results
+    if function is None:
+        return None
+    digest = hashlib.sha256()
+    pending = [function.__code__]
+    while pending:
+        code = pending.pop()
+        digest.update(code.co_code)
+        for const in code.co_consts:
+            # Nested code objects (generator expressions, lambdas) are hashed by content, not repr
+            if hasattr(const, 'co_code'):
+                pending.append(const)
+            else:
+                digest.update(repr(const).encode())
+    return digest.hexdigest()
+
+def normalize_titles(titles, words_to_remove=None):
+    # Vectorized preprocess_text: strip punctuation from each unique title once and, when a stopword
+    # set is given, drop those words (case insensitive) and collapse whitespace as split/join does
+    codes, unique_titles = pd.factorize(titles)
+    normalized = pd.Series(unique_titles, dtype=object).str.replace(r'[^\w\s]', '', regex=True)
+    if words_to_remove is not None:
+        if words_to_remove:
+            pattern = r'(?<!\S)(?:{})(?!\S)'.format('|'.join(re.escape(word) for word in sorted(words_to_remove)))
+            normalized = normalized.str.replace(pattern, '', regex=True, flags=re.IGNORECASE)
+        normalized = normalized.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+    # Map the results back onto the original rows (factorize marks missing titles with -1)
+    mapped = normalized.to_numpy()[codes]
+    mapped[codes == -1] = np.nan
+    return pd.Series(mapped, index=titles.index, name=titles.name)
+
+def benchmark_preprocess_text(titles, text_preprocessor, words_to_remove=None, repeats=3):
+    # Compare the row-wise apply with normalize_titles on the same titles and check they agree
+    apply_times, vectorized_times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        expected = titles.apply(text_preprocessor)
+        apply_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        normalized = normalize_titles(titles, words_to_remove)
+        vectorized_times.append(time.perf_counter() - start)
+    mismatches = int((expected.astype(object) != normalized.astype(object)).sum())
+    print("preprocess_text via apply: {:.3f}s, normalize_titles: {:.3f}s ({:.1f}x) on {} titles, {} mismatches".format(
+        min(apply_times), min(vectorized_times), min(apply_times) / min(vectorized_times), len(titles), mismatches))
+    return min(apply_times), min(vectorized_times), mismatches
+
+def build_cohort(folder_path, clean_text=False, words_to_remove=None, short_threshold=None, medium_threshold=None,
+                 columns_to_drop=(), cache_dir=CACHE_DIR):
+    # Columns dropped below are never read, except 'los' which is needed for the LOS bins
+    unused_columns = [col for col in columns_to_drop if col != 'los']
 
     # Load the datasets
-    admissions = pd.read_csv(folder_path + 'admissions.csv')
-    patients = pd.read_csv(folder_path + 'patients.csv')
-    icustays = pd.read_csv(folder_path + 'icustays.csv')
-    diagnoses_icd = pd.read_csv(folder_path + 'diagnoses_icd.csv')
-    d_icd_diagnoses = pd.read_csv(folder_path + 'd_icd_diagnoses.csv')
+    admissions = load_table(folder_path, 'admissions', exclude=unused_columns, cache_dir=cache_dir)
+    patients = load_table(folder_path, 'patients', exclude=unused_columns, cache_dir=cache_dir)
+    icustays = load_table(folder_path, 'icustays', exclude=unused_columns, cache_dir=cache_dir)
+    diagnoses_icd = load_table(folder_path, 'diagnoses_icd', exclude=unused_columns, cache_dir=cache_dir)
+    d_icd_diagnoses = load_table(folder_path, 'd_icd_diagnoses', cache_dir=cache_dir)
 
     # Merge datasets based on common columns using inner join
     merged_data = pd.merge(admissions, patients, on='subject_id', how='inner')
     merged_data = pd.merge(merged_data, icustays, on=['subject_id', 'hadm_id'], how='inner')
     merged_data = pd.merge(merged_data, diagnoses_icd, on=['subject_id', 'hadm_id'], how='inner')
-    d_icd_diagnoses['long_title'] = d_icd_diagnoses['long_title'].apply(preprocess_text)
+    if clean_text:
+        d_icd_diagnoses['long_title'] = normalize_titles(d_icd_diagnoses['long_title'], words_to_remove)
     merged_data = pd.merge(merged_data, d_icd_diagnoses, on=['icd_code', 'icd_version'], how='inner')
-    merged_data.rename(columns={'hospital_expire_flag': 'label', 'long_title': 'text'}, inplace=True)
 
-    # Feature Engineering
-    categories = ['Short', 'Medium', 'Long']
-    short_threshold = 2.0
-    medium_threshold = 5.0
+    return finish_cohort(merged_data, short_threshold, medium_threshold, columns_to_drop)
+
+def finish_cohort(merged_data, short_threshold=None, medium_threshold=None, columns_to_drop=()):
+    merged_data.rename(columns={'hospital_expire_flag': 'label', 'long_title': 'text'}, inplace=True)
 
     # Categorize Length of Stay (LOS)
-    merged_data['LOS_Category'] = pd.cut(merged_data['los'], bins=[0, short_threshold, medium_threshold, float('inf')],
-                                         labels=categories, right=False)
+    if short_threshold is not None:
+        merged_data['LOS_Category'] = pd.cut(merged_data['los'], bins=[0, short_threshold, medium_threshold, float('inf')],
+                                             labels=['Short', 'Medium', 'Long'], right=False)
 
     # Drop unnecessary columns
-    columns_to_drop = ['deathtime', 'admit_provider_id', 'dod', 'los', 'language', 'seq_num', 'insurance']
-    merged_data = merged_data.drop(columns=columns_to_drop)
+    merged_data = merged_data.drop(columns=list(columns_to_drop), errors='ignore')
 
     # Handling missing values
     merged_data.dropna(inplace=True)
 
     return merged_data
 
+def build_cohort_chunked(folder_path, output_path, clean_text=False, words_to_remove=None, short_threshold=None,
+                         medium_threshold=None, columns_to_drop=(), memory_limit_mb=JOIN_MEMORY_LIMIT_MB,
+                         cache_dir=CACHE_DIR):
+    # Same cohort as build_cohort, but diagnoses_icd is streamed in subject_id partitions that are joined
+    # against indexed stay and title lookups and appended to output_path, so only one partition is in memory
+    unused_columns = [col for col in columns_to_drop if col != 'los']
+    admissions = load_table(folder_path, 'admissions', exclude=unused_columns, cache_dir=cache_dir)
+    patients = load_table(folder_path, 'patients', exclude=unused_columns, cache_dir=cache_dir)
+    icustays = load_table(folder_path, 'icustays', exclude=unused_columns, cache_dir=cache_dir)
+    d_icd_diagnoses = load_table(folder_path, 'd_icd_diagnoses', cache_dir=cache_dir)
+    if clean_text:
+        d_icd_diagnoses['long_title'] = normalize_titles(d_icd_diagnoses['long_title'], words_to_remove)
+
+    # One row per ICU stay, indexed on the diagnoses join keys
+    stays = pd.merge(admissions, patients, on='subject_id', how='inner')
+    stays = pd.merge(stays, icustays, on=['subject_id', 'hadm_id'], how='inner')
+    stays = stays.set_index(['subject_id', 'hadm_id']).sort_index()
+    titles = d_icd_diagnoses.set_index(['icd_code', 'icd_version']).sort_index()
+
+    diagnoses_file = pq.ParquetFile(convert_table(folder_path, 'diagnoses_icd', cache_dir))
+    diagnoses_columns = [col for col in diagnoses_file.schema_arrow.names if col not in unused_columns]
+
+    # Keep the column order of the in-memory join
+    column_order = list(admissions.columns) + [col for col in patients.columns if col != 'subject_id']
+    column_order += [col for col in icustays.columns if col not in ('subject_id', 'hadm_id')]
+    column_order += [col for col in diagnoses_columns if col not in ('subject_id', 'hadm_id')]
+    column_order += [col for col in d_icd_diagnoses.columns if col not in ('icd_code', 'icd_version')]
+    del admissions, patients, icustays, d_icd_diagnoses
+
+    # Size partitions from what is left of the memory ceiling once the lookups are loaded; each joined
+    # row is held a few times over by join/dropna, hence the factor of 4
+    lookup_bytes = stays.memory_usage(deep=True).sum() + titles.memory_usage(deep=True).sum()
+    row_bytes = stays.memory_usage(deep=True).sum() / max(len(stays), 1) + titles.memory_usage(deep=True).sum() / max(len(titles), 1) + 64
+    budget = memory_limit_mb * 2**20 - lookup_bytes
+    if budget <= 0:
+        raise MemoryError('memory_limit_mb={} does not fit the {:.0f} MB of stay/title lookups'.format(memory_limit_mb, lookup_bytes / 2**20))
+    rows_per_chunk = max(int(budget / (4 * row_bytes)), 1000)
+
+    def join_partition(partition):
+        merged_data = partition.join(stays, on=['subject_id', 'hadm_id'], how='inner')
+        merged_data = merged_data.join(titles, on=['icd_code', 'icd_version'], how='inner')
+        return finish_cohort(merged_data[column_order], short_threshold, medium_threshold, columns_to_drop)
+
+    writer = None
+    carry = None
+    merged_data = None
+    for batch in diagnoses_file.iter_batches(batch_size=rows_per_chunk, columns=diagnoses_columns):
+        partition = batch.to_pandas()
+        if carry is not None:
+            partition = pd.concat([carry, partition], ignore_index=True)
+
+        # Hold back the last subject, whose diagnoses may continue in the next batch
+        held = (partition['subject_id'] == partition['subject_id'].iat[-1]).to_numpy()
+        carry = partition[held]
+        merged_data = join_partition(partition[~held])
+        if len(merged_data):
+            table = pa.Table.from_pandas(merged_data, preserve_index=False, schema=writer.schema if writer else None)
+            writer = writer or pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+
+    if carry is not None and len(carry):
+        merged_data = join_partition(carry)
+        if len(merged_data):
+            table = pa.Table.from_pandas(merged_data, preserve_index=False, schema=writer.schema if writer else None)
+            writer = writer or pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+
+    if writer is not None:
+        writer.close()
+    elif merged_data is not None:
+        merged_data.to_parquet(output_path, index=False)
+    else:
+        join_partition(diagnoses_file.schema_arrow.empty_table().to_pandas()).to_parquet(output_path, index=False)
+    return output_path
+
+def read_proc_status(field):
+    # Value of a /proc/self/status memory field, in kB
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+# Phase records of this process: the study/trial they belong to, the totals per phase since the current
+# trial started, the phases currently open, the timeline lines not yet written and the file they go to,
+# and the peak RSS folded in before profile_phase last reset the high-water mark
+_profile = {'context': {}, 'phases': {}, 'stack': [], 'timeline': [],
+            'timeline_path': os.path.join(STUDY_DIR, PROFILE_TIMELINE), 'peak_kb': 0}
+
+def read_peak_rss():
+    # Peak RSS of this process in kB; profile_phase resets VmHWM on every phase entry, so the peak before the
+    # last reset is kept in _profile
+    return max(_profile['peak_kb'], read_proc_status('VmHWM'))
+
+def flush_profile(path=None):
+    # Append the buffered timeline lines to path, or else to the current study's timeline; study workers
+    # share the file, so writes are serialized
+    lines, _profile['timeline'] = _profile['timeline'], []
+    if not lines:
+        return
+    path = path or _profile['timeline_path']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(''.join(json.dumps(line) + '\n' for line in lines))
+
+@contextlib.contextmanager
+def profile_phase(name, samples=0, tokens=0):
+    # Time a block and record its samples, tokens and peak RSS under name; the yielded record takes
+    # counts only known inside the block. The high-water mark is reset on entry, after folding it into
+    # read_peak_rss, and an enclosing phase keeps the peaks of the phases nested in it
+    record = {'phase': name, 'samples': samples, 'tokens': tokens}
+    if not PROFILE_PHASES:
+        yield record
+        return
+    stack = _profile['stack']
+    peak_kb = read_proc_status('VmHWM')
+    _profile['peak_kb'] = max(_profile['peak_kb'], peak_kb)
+    if stack:
+        stack[-1]['peak_kb'] = max(stack[-1]['peak_kb'], peak_kb)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    record['peak_kb'] = 0
+    stack.append(record)
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        # Named ranges in torch profiler traces
+        with torch.profiler.record_function(name):
+            yield record
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        peak_kb = max(record.pop('peak_kb'), read_proc_status('VmHWM'))
+        if stack:
+            stack[-1]['peak_kb'] = max(stack[-1]['peak_kb'], peak_kb)
+        totals = _profile['phases'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'samples': 0, 'tokens': 0,
+                                                      'peak_rss_mb': 0.0})
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['samples'] += record['samples']
+        totals['tokens'] += record['tokens']
+        totals['peak_rss_mb'] = max(totals['peak_rss_mb'], peak_kb / 1024)
+        _profile['timeline'].append(dict(_profile['context'], start=started, seconds=seconds,
+                                         peak_rss_mb=peak_kb / 1024, **record))
+        if len(_profile['timeline']) >= 10000:
+            flush_profile()
+
+def profile_summary():
+    # Totals per phase since the current trial started, with samples/sec and tokens/sec
+    return {name: dict(totals, samples_per_sec=totals['samples'] / totals['seconds'] if totals['seconds'] else 0.0,
+                       tokens_per_sec=totals['tokens'] / totals['seconds'] if totals['seconds'] else 0.0)
+            for name, totals in _profile['phases'].items()}
+
+def profile_trial(objective, study_name, study_dir=STUDY_DIR):
+    # Wrap an objective so each trial starts with fresh phase totals, attaches them to the trial as
+    # profile_<phase> user attributes (also when it is pruned or fails) and writes its timeline;
+    # trial PROFILE_TRACE_TRIAL is additionally traced into a Chrome trace next to the study journal
+    timeline_path = os.path.join(study_dir, PROFILE_TIMELINE)
+
+    def run(trial):
+        flush_profile()
+        _profile['timeline_path'] = timeline_path
+        _profile['context'] = {'study': study_name, 'trial': trial.number}
+        _profile['phases'] = {}
+        trace = PROFILE_PHASES and trial.number == PROFILE_TRACE_TRIAL
+        profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) if trace else None
+        try:
+            with profiler if trace else contextlib.nullcontext():
+                return objective(trial)
+        finally:
+            for name, totals in profile_summary().items():
+                trial.set_user_attr('profile_' + name, totals)
+            flush_profile()
+            _profile['context'] = {'study': study_name}
+            if trace:
+                profiler.export_chrome_trace(os.path.join(study_dir, '{}-trial-{}-trace.json'.format(
+                    study_name.replace('/', '__'), trial.number)))
+    return run
+
+def measure_peak_memory(function, *args, **kwargs):
+    # Run function in a forked child and return how far its RSS peaked above the RSS it started
+    # with, in MB, so memory already held by this process does not mask the result
+    def target(conn):
+        try:
+            # Reset the high-water mark inherited from the parent, including the one profile_phase folded in
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            _profile['peak_kb'] = 0
+            baseline = read_proc_status('VmRSS')
+            function(*args, **kwargs)
+            conn.send((read_peak_rss() - baseline) / 1024)
+        except Exception as error:
+            conn.send(error)
+
+    context = multiprocessing.get_context('fork')
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=target, args=(child_conn,))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def compare_join_memory(folder_path, memory_limit_mb=JOIN_MEMORY_LIMIT_MB, cache_dir=CACHE_DIR, **cohort_params):
+    # Report peak RSS of converting the csv files, then of the in-memory and the chunked cohort builds
+    # on the same inputs
+    with tempfile.TemporaryDirectory() as conversion_dir:
+        conversion_peak = measure_peak_memory(lambda: [convert_table(folder_path, name, conversion_dir)
+                                                       for name in MIMIC_DTYPES])
+    probe_path = os.path.join(cache_dir, 'cohort-chunked-probe.parquet')
+    in_memory_peak = measure_peak_memory(build_cohort, folder_path, cache_dir=cache_dir, **cohort_params)
+    chunked_peak = measure_peak_memory(build_cohort_chunked, folder_path, probe_path, memory_limit_mb=memory_limit_mb,
+                                       cache_dir=cache_dir, **cohort_params)
+    os.remove(probe_path)
+    print("Peak memory above baseline, csv to Parquet conversion: {:.0f} MB".format(conversion_peak))
+    print("Peak memory above baseline, in-memory join: {:.0f} MB".format(in_memory_peak))
+    print("Peak memory above baseline, chunked join (limit {} MB): {:.0f} MB".format(memory_limit_mb, chunked_peak))
+    return in_memory_peak, chunked_peak
+
+def load_cohort(folder_path, clean_text=False, words_to_remove=None, short_threshold=None, medium_threshold=None,
+                columns_to_drop=(), chunked=CHUNKED_JOIN, memory_limit_mb=JOIN_MEMORY_LIMIT_MB, cache_dir=CACHE_DIR):
+    # The merged cohort is materialized once per combination of source files and build parameters
+    os.makedirs(cache_dir, exist_ok=True)
+    sources = {name: file_fingerprint(folder_path + name + '.csv', cache_dir) for name in MIMIC_DTYPES}
+    params = {'version': COHORT_VERSION, 'sources': sources,
+              'clean_text': clean_text and function_fingerprint(normalize_titles),
+              'words_to_remove': None if words_to_remove is None else sorted(words_to_remove),
+              'short_threshold': short_threshold, 'medium_threshold': medium_threshold,
+              'columns_to_drop': sorted(columns_to_drop),
+              # The chunked join orders rows by diagnosis rather than by admission
+              'chunked': chunked}
+    fingerprint = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    cohort_path = os.path.join(cache_dir, 'cohort-{}.parquet'.format(fingerprint[:16]))
+    if os.path.exists(cohort_path):
+        return pd.read_parquet(cohort_path)
+
+    if chunked:
+        build_cohort_chunked(folder_path, cohort_path + '.tmp', clean_text, words_to_remove, short_threshold,
+                             medium_threshold, columns_to_drop, memory_limit_mb, cache_dir)
+        merged_data = None
+    else:
+        merged_data = build_cohort(folder_path, clean_text, words_to_remove, short_threshold, medium_threshold,
+                                   columns_to_drop, cache_dir)
+        merged_data.to_parquet(cohort_path + '.tmp')
+    os.replace(cohort_path + '.tmp', cohort_path)
+    with open(cohort_path.replace('.parquet', '.json'), 'w') as f:
+        json.dump(params, f, indent=2)
+    return merged_data if merged_data is not None else pd.read_parquet(cohort_path)
+
+def grouped_split(frame, group_column=SPLIT_GROUP_COLUMN, test_size=SPLIT_TEST_SIZE, val_size=SPLIT_VAL_SIZE,
+                  seed=SPLIT_SEED, cache_dir=CACHE_DIR):
+    # Row positions of the train, validation and test sets with all rows of a group in one set. The split
+    # is computed once per cohort (identified by its row index and group values) and persisted next to
+    # the cohort cache, so every trial and every run sees the same patients in the same set
+    groups = frame[group_column].to_numpy()
+    digest = hashlib.sha256(json.dumps({'group_column': group_column, 'test_size': test_size, 'val_size': val_size,
+                                        'seed': seed}, sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(frame.index.to_numpy()).tobytes())
+    digest.update(np.ascontiguousarray(groups).tobytes())
+    split_path = os.path.join(cache_dir, 'splits', 'split-{}.npz'.format(digest.hexdigest()[:16]))
+    if os.path.exists(split_path):
+        with np.load(split_path) as saved:
+            return {name: saved[name] for name in ('train', 'val', 'test')}
+
+    # Hold out the test groups, then the validation groups from the rest, mirroring the former
+    # two-stage row split
+    splitter = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=seed)
+    train_val, test = next(splitter.split(groups, groups=groups))
+    splitter = GroupShuffleSplit(n_splits=1, test_size=val_size / (1 - test_size), random_state=seed)
+    train, val = next(splitter.split(train_val, groups=groups[train_val]))
+    split = {'train': train_val[train], 'val': train_val[val], 'test': test}
+
+    os.makedirs(os.path.dirname(split_path), exist_ok=True)
+    with open(split_path + '.tmp', 'wb') as f:
+        np.savez(f, **split)
+    os.replace(split_path + '.tmp', split_path)
+    return split
+
+def split_frames(X, y, split):
+    # Reorder X and y once into train, validation, test order, so that each set (and train plus
+    # validation) is a contiguous row slice of them: a view that trials share instead of copies
+    order = np.concatenate([split['train'], split['val'], split['test']])
+    X, y = X.iloc[order], y.iloc[order]
+    n_train, n_val = len(split['train']), len(split['val'])
+    return {'train': (X.iloc[:n_train], y.iloc[:n_train]),
+            'val': (X.iloc[n_train:n_train + n_val], y.iloc[n_train:n_train + n_val]),
+            'train_val': (X.iloc[:n_train + n_val], y.iloc[:n_train + n_val]),
+            'test': (X.iloc[n_train + n_val:], y.iloc[n_train + n_val:])}
+
+# Open token caches of this process, keyed by directory
+_token_caches = {}
+
+def read_token_cache_state(path):
+    # Committed contents of a token cache: the number of texts and the bytes of ids.bin and texts.jsonl
+    # holding them. Appends write state.json last, so bytes past these are an interrupted append
+    state_path = os.path.join(path, 'state.json')
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    # Caches written before state.json existed
+    offsets_path = os.path.join(path, 'offsets.bin')
+    count = os.path.getsize(offsets_path) // 8 if os.path.exists(offsets_path) else 0
+    ids_bytes = int(np.fromfile(offsets_path, dtype=np.int64, count=count)[-1]) * 4 if count else 0
+    texts_path = os.path.join(path, 'texts.jsonl')
+    return {'count': count, 'ids_bytes': ids_bytes, 'texts_bytes': os.path.getsize(texts_path) if count else 0}
+
+def refresh_token_cache(cache):
+    # Extend the index and remap the cache files if another trial or run appended texts since they
+    # were last read, parsing only the texts that are new; the caller holds the cache lock
+    state = read_token_cache_state(cache['path'])
+    if state['count'] == cache['state']['count']:
+        return cache
+    if state['count'] < cache['state']['count']:
+        # The cache was deleted and rebuilt
+        cache.update(index={}, state={'count': 0, 'ids_bytes': 0, 'texts_bytes': 0})
+
+    with open(os.path.join(cache['path'], 'texts.jsonl'), 'rb') as f:
+        f.seek(cache['state']['texts_bytes'])
+        lines = f.read(state['texts_bytes'] - cache['state']['texts_bytes']).decode().split('\n')[:-1]
+    cache['index'].update((json.loads(line), cache['state']['count'] + row) for row, line in enumerate(lines))
+    cache['offsets'] = np.memmap(os.path.join(cache['path'], 'offsets.bin'), dtype=np.int64, mode='r', shape=(state['count'],))
+    if state['ids_bytes']:
+        cache['ids'] = np.memmap(os.path.join(cache['path'], 'ids.bin'), dtype=np.int32, mode='r',
+                                 shape=(state['ids_bytes'] // 4,))
+    else:
+        cache['ids'] = np.zeros(1, dtype=np.int32)
+    cache['state'] = state
+    cache['count'] = state['count']
+    return cache
+
+def append_token_cache(cache, texts, encoded):
+    # Append texts and their token ids under the exclusive cache lock: first cut off whatever an
+    # interrupted append left past the committed state, then write the data, then commit the new state
+    path = cache['path']
+    state = cache['state']
+    for name, size in (('ids.bin', state['ids_bytes']), ('offsets.bin', state['count'] * 8),
+                       ('texts.jsonl', state['texts_bytes'])):
+        with open(os.path.join(path, name), 'ab') as f:
+            f.truncate(size)
+
+    ids = np.concatenate([np.asarray(ids, dtype=np.int32) for ids in encoded])
+    lengths = np.array([len(ids) for ids in encoded], dtype=np.int64)
+    lines = ''.join(json.dumps(text) + '\n' for text in texts).encode()
+    with open(os.path.join(path, 'ids.bin'), 'ab') as f:
+        f.write(ids.tobytes())
+    with open(os.path.join(path, 'offsets.bin'), 'ab') as f:
+        f.write((state['ids_bytes'] // 4 + np.cumsum(lengths)).tobytes())
+    with open(os.path.join(path, 'texts.jsonl'), 'ab') as f:
+        f.write(lines)
+
+    new_state = {'count': state['count'] + len(texts), 'ids_bytes': state['ids_bytes'] + ids.nbytes,
+                 'texts_bytes': state['texts_bytes'] + len(lines)}
+    with open(os.path.join(path, 'state.json.tmp'), 'w') as f:
+        json.dump(new_state, f)
+    os.replace(os.path.join(path, 'state.json.tmp'), os.path.join(path, 'state.json'))
+    return refresh_token_cache(cache)
+
+def open_token_cache(model_name, max_length, cache_dir=CACHE_DIR):
+    # A token cache is a directory of append-only files: the texts (one JSON string per line), their
+    # token ids concatenated into one int32 array, the end offset of each text's ids, and state.json
+    # recording how much of them is committed
+    path = os.path.join(cache_dir, 'tokens', '{}-{}'.format(model_name.replace('/', '__'), max_length))
+    os.makedirs(path, exist_ok=True)
+    cache = _token_caches.setdefault(path, {'path': path, 'count': 0, 'index': {},
+                                            'offsets': np.zeros(0, dtype=np.int64), 'ids': np.zeros(1, dtype=np.int32),
+                                            'state': {'count': 0, 'ids_bytes': 0, 'texts_bytes': 0}})
+    with open(os.path.join(path, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        return refresh_token_cache(cache)
+
+def check_tokenizer_parity(texts, model_names=TOKENIZER_PARITY_MODELS, max_length=128):
+    # The fast tokenizers must reproduce BertTokenizer exactly, otherwise results (and cached
+    # token ids) would not be comparable with runs made with the pure-Python implementation
+    for model_name in model_names:
+        slow_tokenizer = BertTokenizer.from_pretrained(model_name)
+        fast_tokenizer = BertTokenizerFast.from_pretrained(model_name)
+        expected = slow_tokenizer(list(texts), padding=True, truncation=True, max_length=max_length)
+        actual = fast_tokenizer(list(texts), padding=True, truncation=True, max_length=max_length)
+        for key in ('input_ids', 'attention_mask'):
+            mismatches = [i for i, (a, b) in enumerate(zip(expected[key], actual[key])) if a != b]
+            if mismatches:
+                raise AssertionError("{}: fast tokenizer {} differs for {} texts, e.g. {!r}".format(
+                    model_name, key, len(mismatches), texts[mismatches[0]]))
+        print("{}: fast tokenizer matches BertTokenizer on {} texts".format(model_name, len(texts)))
+
+def benchmark_tokenizers(texts, model_name='bert-base-uncased', max_length=128):
+    # Tokenization throughput of the pure-Python and the fast tokenizer on the same texts
+    texts = list(texts)
+    results = {}
+    for name, tokenizer_class in [('BertTokenizer', BertTokenizer), ('BertTokenizerFast', BertTokenizerFast)]:
+        tokenizer = tokenizer_class.from_pretrained(model_name)
+        start = time.perf_counter()
+        tokenizer(texts, padding=True, truncation=True, max_length=max_length)
+        results[name] = len(texts) / (time.perf_counter() - start)
+        print("{}: {:.0f} texts/sec ({} workers)".format(name, results[name], os.environ['RAYON_RS_NUM_CPUS']))
+    return results
+
+# Tokenizers and pristine pretrained models, loaded once per process (forked study workers inherit them)
+_tokenizers = {}
+_pretrained_models = {}
+
+def load_tokenizer(model_name):
+    if model_name not in _tokenizers:
+        _tokenizers[model_name] = BertTokenizerFast.from_pretrained(model_name)
+    return _tokenizers[model_name]
+
+def load_pretrained_model(model_name, num_labels=2):
+    # Deserialize the checkpoint once, then hand every caller its own copy with a freshly
+    # initialized classifier head, so trials neither reload ~440 MB nor share trained weights
+    key = (model_name, num_labels)
+    if key not in _pretrained_models:
+        _pretrained_models[key] = BertForSequenceClassification.from_pretrained(model_name, num_labels=num_labels)
+    model = copy.deepcopy(_pretrained_models[key])
+    # Same initialization as BertPreTrainedModel applies to a new head
+    model.classifier.weight.data.normal_(mean=0.0, std=model.config.initializer_range)
+    model.classifier.bias.data.zero_()
+    return model
+
+def benchmark_model_loading(model_name='bert-base-uncased', num_labels=3, repeats=3):
+    # Per-trial model setup time with from_pretrained and with the in-process cache
+    results = {}
+    for name, load in [('from_pretrained', lambda: BertForSequenceClassification.from_pretrained(model_name, num_labels=num_labels)),
+                       ('load_pretrained_model', lambda: load_pretrained_model(model_name, num_labels))]:
+        load()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            load()
+        results[name] = (time.perf_counter() - start) / repeats
+        print("{}: {:.0f} ms per model".format(name, results[name] * 1000))
+    return results
+
+def lookup_token_rows(tokenizer, model_name, texts, max_length=128, cache_dir=CACHE_DIR):
+    # Row of each text in the (model_name, max_length) token cache, tokenizing texts not seen before
+    codes, unique_texts = pd.factorize(pd.Series(texts))
+    cache = open_token_cache(model_name, max_length, cache_dir)
+    missing = [text for text in unique_texts if text not in cache['index']]
+    if missing:
+        path = cache['path']
+        with open(os.path.join(path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            refresh_token_cache(cache)
+            missing = [text for text in missing if text not in cache['index']]
+            if missing:
+                with profile_phase('tokenize', samples=len(missing)) as phase:
+                    encoded = tokenizer(missing, truncation=True, max_length=max_length)['input_ids']
+                    phase['tokens'] = sum(len(ids) for ids in encoded)
+                append_token_cache(cache, missing, encoded)
+
+    rows = np.array([cache['index'][text] for text in unique_texts], dtype=np.int64)[codes]
+    return cache, rows
+
+def pad_token_rows(cache, rows, pad_token_id):
+    # Gather the ids of the given cache rows from the flat array and pad them to the longest row
+    ends = cache['offsets'][rows]
+    starts = np.where(rows > 0, cache['offsets'][rows - 1], 0)
+    lengths = ends - starts
+    width = int(lengths.max()) if len(lengths) else 0
+    positions = np.arange(width)
+    attention_mask = positions < lengths[:, None]
+    input_ids = np.where(attention_mask, cache['ids'][np.minimum(starts[:, None] + positions, len(cache['ids']) - 1)],
+                         pad_token_id)
+    return {'input_ids': torch.from_numpy(input_ids.astype(np.int64)),
+            'token_type_ids': torch.zeros(input_ids.shape, dtype=torch.int64),
+            'attention_mask': torch.from_numpy(attention_mask.astype(np.int64))}
+
+def encode_texts(tokenizer, model_name, texts, max_length=128, cache_dir=CACHE_DIR):
+    # Equivalent to tokenizer(texts, padding=True, truncation=True, max_length=max_length, return_tensors='pt'),
+    # but every unique text is tokenized only once per (model_name, max_length) across trials and runs
+    cache, rows = lookup_token_rows(tokenizer, model_name, texts, max_length, cache_dir)
+    return pad_token_rows(cache, rows, tokenizer.pad_token_id)
+
+# Open encoder feature caches of this process, keyed by directory
+_feature_caches = {}
+
+def refresh_feature_cache(cache):
+    # Remap the features appended by other trials or runs; the caller holds the cache lock. Only the
+    # vectors recorded in state.json are committed, anything past them is an interrupted append
+    values_path = os.path.join(cache['path'], 'features.bin')
+    state_path = os.path.join(cache['path'], 'state.json')
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    else:
+        # Caches written before state.json existed: keep the whole rows at the start of the file
+        size = os.path.getsize(values_path) // (2 * cache['hidden_size']) if os.path.exists(values_path) else 0
+        if cache['layer'] == 'pooled':
+            state = {'count': size, 'size': size}
+        else:
+            count = int(np.searchsorted(cache['tokens']['offsets'], size, side='right'))
+            state = {'count': count, 'size': int(cache['tokens']['offsets'][count - 1]) if count else 0}
+    if state['size'] == cache['size']:
+        return cache
+    cache['count'] = state['count']
+    cache['values'] = np.memmap(values_path, dtype=np.float16, mode='r', shape=(state['size'], cache['hidden_size'])) if state['size'] else None
+    cache['size'] = state['size']
+    return cache
+
+def lookup_feature_rows(model, tokenizer, model_name, texts, trainable_layers, max_length=128, batch_size=64,
+                        cache_dir=CACHE_DIR):
+    # Frozen-encoder features of each text, computed once per unique text and appended to a memory-mapped
+    # float16 array: the pooled embedding when only the head is trained, otherwise the hidden states
+    # entering the lowest trainable layer, stored per token in the same layout as the token cache
+    token_cache, rows = lookup_token_rows(tokenizer, model_name, texts, max_length, cache_dir)
+    layer = 'pooled' if trainable_layers == 0 else model.config.num_hidden_layers - trainable_layers
+    path = os.path.join(cache_dir, 'features', '{}-{}-{}'.format(model_name.replace('/', '__'), max_length, layer))
+    os.makedirs(path, exist_ok=True)
+    cache = _feature_caches.setdefault(path,
+                                       {'path': path, 'layer': layer, 'hidden_size': model.config.hidden_size, 'size': -1})
+    cache['tokens'] = token_cache
+    with open(os.path.join(path, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        refresh_feature_cache(cache)
+        # Features cover a prefix of the token cache rows; extend it over every row requested
+        needed = int(rows.max()) + 1 if len(rows) else 0
+        if needed > cache['count']:
+            model.eval()
+            size = cache['size']
+            with torch.inference_mode(), open(os.path.join(path, 'features.bin'), 'ab') as f:
+                f.truncate(size * 2 * cache['hidden_size'])
+                for start in range(cache['count'], needed, batch_size):
+                    batch_rows = np.arange(start, min(start + batch_size, needed))
+                    outputs = model.bert(**pad_token_rows(token_cache, batch_rows, tokenizer.pad_token_id),
+                                         output_hidden_states=layer != 'pooled')
+                    if layer == 'pooled':
+                        values = outputs.pooler_output
+                    else:
+                        mask = pad_token_rows(token_cache, batch_rows, tokenizer.pad_token_id)['attention_mask'].bool()
+                        values = outputs.hidden_states[layer][mask]
+                    f.write(values.to(torch.float16).numpy().tobytes())
+                    size += len(values)
+            # Commit the appended rows only once they are written
+            with open(os.path.join(path, 'state.json.tmp'), 'w') as f:
+                json.dump({'count': needed, 'size': size}, f)
+            os.replace(os.path.join(path, 'state.json.tmp'), os.path.join(path, 'state.json'))
+            refresh_feature_cache(cache)
+    return cache, rows
+
+def gather_features(cache, rows):
+    # Pooled embeddings of the given rows, or their hidden states padded to the longest row with a mask
+    if cache['layer'] == 'pooled':
+        return {'pooled_output': torch.from_numpy(cache['values'][rows].astype(np.float32))}
+    offsets = cache['tokens']['offsets']
+    ends = offsets[rows]
+    starts = np.where(rows > 0, offsets[rows - 1], 0)
+    lengths = ends - starts
+    positions = np.arange(int(lengths.max()))
+    attention_mask = positions < lengths[:, None]
+    hidden_states = cache['values'][np.minimum(starts[:, None] + positions, len(cache['values']) - 1)].astype(np.float32)
+    hidden_states[~attention_mask] = 0
+    return {'hidden_states': torch.from_numpy(hidden_states),
+            'attention_mask': torch.from_numpy(attention_mask.astype(np.int64))}
+
+def freeze_encoder(model, trainable_layers):
+    # Leave only the classifier head (plus the pooler and top trainable_layers layers when k > 0) trainable
+    for parameter in model.bert.parameters():
+        parameter.requires_grad = False
+    if trainable_layers > 0:
+        for module in list(model.bert.encoder.layer[-trainable_layers:]) + [model.bert.pooler]:
+            for parameter in module.parameters():
+                parameter.requires_grad = True
+    return [parameter for parameter in model.parameters() if parameter.requires_grad]
+
+def classify_features(model, features, trainable_layers, labels=None):
+    # The part of BertForSequenceClassification above the cached features
+    if trainable_layers == 0:
+        pooled_output = features['pooled_output']
+    else:
+        hidden_states = features['hidden_states']
+        # Additive mask, as BertModel builds it, so padded positions get no attention
+        attention_mask = (1.0 - features['attention_mask'][:, None, None, :].float()) * torch.finfo(torch.float32).min
+        for layer in model.bert.encoder.layer[-trainable_layers:]:
+            output = layer(hidden_states, attention_mask=attention_mask)
+            hidden_states = output[0] if isinstance(output, tuple) else output
+        pooled_output = model.bert.pooler(hidden_states)
+    logits = model.classifier(model.dropout(pooled_output))
+    loss = None if labels is None else torch.nn.functional.cross_entropy(logits, labels)
+    return SequenceClassifierOutput(loss=loss, logits=logits)
+
+def deduplicate_examples(texts, labels=None):
+    # Unique texts, or unique (text, label) pairs, in order of first occurrence, with the number of
+    # rows each one stands for and the index of every row's unique example
+    frame = pd.DataFrame({'text': np.asarray(texts)})
+    if labels is not None:
+        frame['label'] = np.asarray(labels)
+    inverse = frame.groupby(list(frame.columns), sort=False).ngroup().to_numpy()
+    unique = frame.drop_duplicates().reset_index(drop=True)
+    counts = np.bincount(inverse, minlength=len(unique))
+    return unique, counts, inverse
+
+def weighted_loss(logits, labels, weights, total_weight=None):
+    # Cross-entropy with each example counted weights times; with unit weights this is the usual mean loss.
+    # With total_weight (the weight of the whole accumulated batch) the losses of its micro-batches add up
+    # to the loss of the whole batch
+    losses = torch.nn.functional.cross_entropy(logits.float(), labels, reduction='none')
+    return (losses * weights).sum() / (weights.sum() if total_weight is None else total_weight)
+
+def autocast_context(precision):
+    # Forward passes under bf16 autocast on CPU for precision='bf16', unchanged for 'fp32'
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError("Unknown precision {!r}, expected 'fp32' or 'bf16'".format(precision))
+    return torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+def make_batches(lengths, batch_size, bucket=True, shuffle=False, max_tokens=None, bucket_batches=50):
+    # Split example indices into batches. With bucket=True examples are sorted by token length within
+    # windows of bucket_batches batches, so each batch holds similarly long texts and pads little;
+    # with max_tokens a batch is closed once its padded size would exceed that many tokens
+    order = np.random.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    window = batch_size * bucket_batches if bucket else len(order)
+    batches = []
+    for start in range(0, len(order), max(window, 1)):
+        chunk = order[start:start + window]
+        if bucket:
+            chunk = chunk[np.argsort(lengths[chunk], kind='stable')]
+        if max_tokens is None:
+            batches.extend(chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size))
+            continue
+        first, longest = 0, 0
+        for i, index in enumerate(chunk):
+            longest = max(longest, lengths[index])
+            if i > first and (i + 1 - first) * longest > max_tokens:
+                batches.append(chunk[first:i])
+                first, longest = i, lengths[index]
+        if first < len(chunk):
+            batches.append(chunk[first:])
+
+    # Visit bucketed batches in random order so training does not run shortest-first
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    return batches
+
+def select_batch(inputs, indices):
+    # Slice a batch out of encode_texts output and drop the padding beyond its longest example
+    indices = torch.as_tensor(indices)
+    width = int(inputs['attention_mask'][indices].sum(dim=1).max())
+    return {k: v[indices, :width] for k, v in inputs.items()}
+
+class TokenRowDataset(torch.utils.data.Dataset):
+    # Holds only each example's row in the token cache and its label; ids are gathered and padded
+    # per batch in collate, so memory does not grow with a padded copy of the whole dataset
+    def __init__(self, cache, rows, labels, pad_token_id):
+        self.cache = cache
+        self.rows = rows
+        self.labels = torch.tensor(list(labels))
+        self.pad_token_id = pad_token_id
+        self.lengths = cache['offsets'][rows] - np.where(rows > 0, cache['offsets'][rows - 1], 0)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return index
+
+    def collate(self, indices):
+        indices = np.asarray(indices)
+        return torch.from_numpy(indices), pad_token_rows(self.cache, self.rows[indices], self.pad_token_id), self.labels[indices]
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    # Draws a fresh set of batches from make_batches for every epoch
+    def __init__(self, lengths, batch_size, bucket=True, shuffle=False, max_tokens=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket = bucket
+        self.shuffle = shuffle
+        self.max_tokens = max_tokens
+        self.n_batches = None
+
+    def __iter__(self):
+        return iter(make_batches(self.lengths, self.batch_size, self.bucket, self.shuffle, self.max_tokens))
+
+    def __len__(self):
+        # make_batches sorts the whole dataset, so the count is computed on the first call only
+        if self.n_batches is None:
+            self.n_batches = len(make_batches(self.lengths, self.batch_size, self.bucket, False, self.max_tokens))
+        return self.n_batches
+
+def make_data_loader(tokenizer, model_name, texts, labels, batch_size, shuffle=False, max_length=128, bucket=True,
+                     max_tokens=None, num_workers=DATALOADER_WORKERS, cache_dir=CACHE_DIR):
+    # Mini-batch loader over cached token ids; worker processes gather, pad and (on GPU machines)
+    # pin the next batches while the current one is being processed
+    cache, rows = lookup_token_rows(tokenizer, model_name, texts, max_length, cache_dir)
+    dataset = TokenRowDataset(cache, rows, labels, tokenizer.pad_token_id)
+    sampler = BucketBatchSampler(dataset.lengths, batch_size, bucket, shuffle, max_tokens)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=dataset.collate,
+                                       num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                                       persistent_workers=num_workers > 0,
+                                       prefetch_factor=2 if num_workers > 0 else None)
+
+def predict_loader(model, loader):
+    # Class predictions for every example of a loader, in the original example order
+    model.eval()
+    predictions = np.zeros(len(loader.dataset), dtype=np.int64)
+    with torch.no_grad():
+        for indices, input_batch, _ in loader:
+            predictions[indices.numpy()] = model(**input_batch).logits.argmax(dim=1).numpy()
+    return predictions
+
+def benchmark_batching(classifier, X, y):
+    # Time one training epoch with fixed-order and with length-bucketed batches; both pad per batch,
+    # which alone removes the padding to the longest text in the whole dataset
+    inputs = encode_texts(load_tokenizer(classifier.model_name), classifier.model_name, X["text"], max_length=128,
+                          cache_dir=classifier.cache_dir)
+    tokens = int(inputs['attention_mask'].sum())
+    results = {}
+    for bucket_by_length in (False, True):
+        trial_classifier = clone(classifier).set_params(epochs=1, early_stopping=False, bucket_by_length=bucket_by_length)
+        start = time.perf_counter()
+        trial_classifier.fit(X, y)
+        results[bucket_by_length] = time.perf_counter() - start
+        print("bucket_by_length={}: epoch {:.1f}s, {:.0f} tokens/sec".format(
+            bucket_by_length, results[bucket_by_length], tokens / results[bucket_by_length]))
+    return results
+
+def check_training_parity(model_name, X, y, batch_size=32, accumulation_steps=4, num_labels=2, tolerance=0.05):
+    # Compare the loss and gradient of one batch under bf16 autocast and/or gradient accumulation with the
+    # fp32 full-batch ones, from identical weights and without dropout, and fail if a loss drifts too far
+    tokenizer = load_tokenizer(model_name)
+    model = load_pretrained_model(model_name, num_labels=num_labels).eval()
+    inputs = tokenizer(list(X["text"][:batch_size]), padding=True, truncation=True, max_length=128, return_tensors='pt')
+    labels = torch.tensor(y[:batch_size].tolist())
+    weights = torch.ones(len(labels))
+
+    def batch_gradient(precision, steps):
+        model.zero_grad()
+        total = 0.0
+        for micro_batch in np.array_split(np.arange(len(labels)), min(steps, len(labels))):
+            with autocast_context(precision):
+                logits = model(**{key: value[micro_batch] for key, value in inputs.items()}).logits
+            loss = weighted_loss(logits, labels[micro_batch], weights[micro_batch], total_weight=weights.sum())
+            loss.backward()
+            total += loss.item()
+        return total, torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+
+    reference_loss, reference_gradient = batch_gradient('fp32', 1)
+    results = {}
+    for precision, steps in (('fp32', accumulation_steps), ('bf16', 1), ('bf16', accumulation_steps)):
+        loss, gradient = batch_gradient(precision, steps)
+        cosine = torch.nn.functional.cosine_similarity(gradient, reference_gradient, dim=0).item()
+        results[(precision, steps)] = (loss, cosine)
+        print("{} x{} accumulation: loss {:.5f} (fp32 {:.5f}), gradient cosine {:.4f}".format(
+            precision, steps, loss, reference_loss, cosine))
+        if abs(loss - reference_loss) > tolerance:
+            raise AssertionError("{} x{} loss {:.5f} differs from fp32 loss {:.5f} by more than {}".format(
+                precision, steps, loss, reference_loss, tolerance))
+    return results
+
+def benchmark_precision(classifier, X, y, modes=(('fp32', 1), ('bf16', 1), ('fp32', 4), ('bf16', 4))):
+    # Time one training epoch and measure its peak RSS for each (precision, accumulation_steps) mode;
+    # bf16 is only faster on CPUs with native bfloat16 support (AVX512-BF16 or AMX)
+    results = {}
+    for precision, accumulation_steps in modes:
+        trial_classifier = clone(classifier).set_params(epochs=1, early_stopping=False, precision=precision,
+                                                        accumulation_steps=accumulation_steps)
+        start = time.perf_counter()
+        peak_memory = measure_peak_memory(trial_classifier.fit, X, y)
+        elapsed = time.perf_counter() - start
+        results[(precision, accumulation_steps)] = (len(X) / elapsed, peak_memory)
+        print("{} x{} accumulation: {:.1f} samples/sec, peak RSS +{:.0f} MB".format(
+            precision, accumulation_steps, len(X) / elapsed, peak_memory))
+    return results
+
+class LogitsModule(torch.nn.Module):
+    # Positional-tensor wrapper around a BertForSequenceClassification for tracing and ONNX export
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).logits
+
+def export_model(model, tokenizer, path_prefix, example_texts, max_length=128):
+    # CPU serving artifacts of a fine-tuned model: a dynamically int8-quantized TorchScript graph,
+    # and an fp32 ONNX graph plus its int8-quantized copy, all with dynamic batch and sequence axes
+    example = tokenizer(list(example_texts[:2]), padding=True, truncation=True, max_length=max_length, return_tensors='pt')
+    example = (example['input_ids'], example['attention_mask'], example['token_type_ids'])
+    names = ['input_ids', 'attention_mask', 'token_type_ids']
+    paths = {'torchscript-int8': path_prefix + '-int8.pt', 'onnx-fp32': path_prefix + '.onnx',
+             'onnx-int8': path_prefix + '-int8.onnx'}
+
+    # Linear layers hold nearly all of BERT's weights; their activations are quantized on the fly
+    quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(LogitsModule(quantized).eval(), example, strict=False), paths['torchscript-int8'])
+        torch.onnx.export(LogitsModule(model).eval(), example, paths['onnx-fp32'], input_names=names, output_names=['logits'],
+                          dynamic_axes=dict({name: {0: 'batch', 1: 'sequence'} for name in names}, logits={0: 'batch'}),
+                          opset_version=17, dynamo=False)
+    quantize_dynamic(paths['onnx-fp32'], paths['onnx-int8'], weight_type=QuantType.QInt8)
+    return paths
+
+def export_runners(model, paths):
+    # One callable per backend mapping a batch of encoded inputs to a logits array
+    runners = {'pytorch-fp32': lambda inputs: model(**inputs).logits.numpy()}
+    script = torch.jit.load(paths['torchscript-int8'])
+    runners['torchscript-int8'] = lambda inputs: script(inputs['input_ids'], inputs['attention_mask'],
+                                                        inputs['token_type_ids']).numpy()
+    for name in ('onnx-fp32', 'onnx-int8'):
+        session = ort.InferenceSession(paths[name], providers=['CPUExecutionProvider'])
+        runners[name] = lambda inputs, session=session: session.run(None, {k: v.numpy() for k, v in inputs.items()})[0]
+    return runners
+
+def run_exported(runner, inputs, batch_size):
+    # Logits of every encoded example and the latency of each length-bucketed batch
+    lengths = inputs['attention_mask'].sum(dim=1).numpy()
+    logits = None
+    latencies = []
+    with torch.inference_mode():
+        for batch in make_batches(lengths, batch_size):
+            start = time.perf_counter()
+            batch_logits = runner(select_batch(inputs, batch))
+            latencies.append(time.perf_counter() - start)
+            if logits is None:
+                logits = np.zeros((len(lengths), batch_logits.shape[1]), dtype=np.float32)
+            logits[batch] = batch_logits
+    return logits, latencies
+
+def compare_exports(model, tokenizer, model_name, paths, X, y, batch_sizes=(1, 16, 64), max_rows=1024, max_length=128,
+                    min_agreement=0.98, min_rows=200):
+    # Accuracy parity of every exported backend against the fp32 model, with CPU latency and
+    # throughput at each batch size; fails if a backend agrees with fp32 on fewer than min_agreement rows.
+    # Below min_rows rows a single borderline flip can miss min_agreement, so it only reports it there
+    X, y = X.iloc[:max_rows], y.iloc[:max_rows]
+    inputs = encode_texts(tokenizer, model_name, X["text"], max_length=max_length)
+    model.eval()
+    reference = None
+    results = []
+    for name, runner in export_runners(model, paths).items():
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            logits, latencies = run_exported(runner, inputs, batch_size)
+            seconds = time.perf_counter() - start
+            predictions = logits.argmax(axis=1)
+            if reference is None:
+                reference = predictions
+            results.append({'backend': name, 'batch_size': batch_size, 'accuracy': accuracy_score(y, predictions),
+                            'agreement_with_fp32': float((predictions == reference).mean()),
+                            'latency_p50_ms': float(np.percentile(latencies, 50)) * 1000,
+                            'rows_per_sec': len(X) / seconds})
+    results = pd.DataFrame(results).set_index(['backend', 'batch_size'])
+    print(results.round(4).to_string())
+    failed = results[results['agreement_with_fp32'] < min_agreement]
+    if len(failed):
+        message = "Exported predictions agree with fp32 on fewer than {:.0%} of {} rows for {}".format(
+            min_agreement, len(X), ', '.join('{} (batch {}): {:.2%}'.format(backend, batch_size, agreement)
+                                             for (backend, batch_size), agreement in failed['agreement_with_fp32'].items()))
+        if len(X) < min_rows:
+            print("Warning: " + message)
+        else:
+            raise AssertionError(message)
+    return results
+
+def save_artifact(model, tokenizer, path, manifest):
+    # Serving artifact: memory-mappable safetensors weights with their config, the tokenizer files and
+    # a small JSON manifest; no optimizer state and nothing that has to be unpickled to load it
+    os.makedirs(path, exist_ok=True)
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    manifest = dict(manifest, artifact_version=ARTIFACT_VERSION, cohort_version=COHORT_VERSION,
+                    normalize_titles=function_fingerprint(normalize_titles))
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+def save_classifier(classifier, path):
+    params = {name: value for name, value in classifier.get_params().items() if name not in LOCAL_PARAMS}
+    return save_artifact(classifier.model, classifier.tokenizer, path,
+                         {'params': params, 'labels': classifier.classes_, 'max_length': 128})
+
+def load_classifier(path, lazy=False, cache_dir=CACHE_DIR):
+    # Rebuild a BERTClassifier from save_classifier output, with its token cache under cache_dir. from_pretrained
+    # memory-maps the safetensors file, and with lazy=True the weights are not even opened until the first prediction
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['artifact_version'] != ARTIFACT_VERSION:
+        raise ValueError("{} has artifact version {}, expected {}".format(path, manifest['artifact_version'], ARTIFACT_VERSION))
+    if manifest['normalize_titles'] != function_fingerprint(normalize_titles):
+        warnings.warn("{} was trained on titles normalized by a different normalize_titles".format(path))
+    params = {name: value for name, value in manifest['params'].items() if name not in LOCAL_PARAMS}
+    classifier = BERTClassifier(cache_dir=cache_dir, **params)
+    classifier.classes_ = manifest['labels']
+    classifier.artifact_path_ = path
+    classifier.tokenizer = BertTokenizerFast.from_pretrained(path)
+    classifier.model = None if lazy else BertForSequenceClassification.from_pretrained(path)
+    return classifier
+
+def benchmark_artifact_loading(classifier, path, texts):
+    # Size on disk and cold-start time (load plus first prediction) of a joblib pickle of the whole
+    # estimator against the safetensors artifact, loaded eagerly and lazily
+    pickle_path = path.rstrip('/') + '.pkl'
+    dump(classifier, pickle_path)
+    sizes = {'joblib': os.path.getsize(pickle_path),
+             'safetensors': sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))}
+    results = {}
+    for name, load in [('joblib', lambda: joblib.load(pickle_path)), ('safetensors', lambda: load_classifier(path)),
+                       ('safetensors (lazy)', lambda: load_classifier(path, lazy=True))]:
+        start = time.perf_counter()
+        loaded = load()
+        loaded_seconds = time.perf_counter() - start
+        loaded.predict(pd.DataFrame({'text': list(texts[:1])}))
+        results[name] = time.perf_counter() - start
+        print("{}: {:.1f} MB, loaded in {:.2f}s, first prediction after {:.2f}s".format(
+            name, sizes[name.split()[0]] / 2 ** 20, loaded_seconds, results[name]))
+    os.remove(pickle_path)
+    return results
+
+class MicroBatcher:
+    # Coalesces concurrent single-text requests into batches of up to max_batch_size, waiting at most
+    # max_wait_ms after the first request of a batch; batches are scored one at a time in a worker thread
+    def __init__(self, classifier, max_batch_size=SERVER_MAX_BATCH_SIZE, max_wait_ms=SERVER_MAX_WAIT_MS):
+        self.classifier = classifier
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.latencies = []
+        self.batch_sizes = []
+        self.started = time.perf_counter()
+
+    async def predict(self, text):
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        probabilities = await future
+        self.latencies.append(time.perf_counter() - start)
+        return probabilities
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = pd.DataFrame({'text': [text for text, _ in batch]})
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self.classifier.predict_proba, texts)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), row in zip(batch, probabilities):
+                future.set_result(row.tolist())
+            self.batch_sizes.append(len(batch))
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        return {'requests': len(latencies), 'batches': len(self.batch_sizes),
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+                'requests_per_sec': len(latencies) / (time.perf_counter() - self.started)}
+
+async def send_http_response(writer, status, payload):
+    data = json.dumps(payload).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, len(data)).encode() + data)
+    await writer.drain()
+
+async def handle_http_connection(reader, writer, batcher):
+    # Minimal keep-alive HTTP/1.1: POST /predict with {"text": ...} and GET /metrics, both answering JSON.
+    # Requests are validated before they join a micro-batch, so a bad request only fails itself
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, target = request_line.decode().split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+            except (ValueError, UnicodeDecodeError):
+                # The stream cannot be resynchronized after a malformed request, so answer and close
+                await send_http_response(writer, '400 Bad Request', {'error': 'malformed HTTP request'})
+                break
+
+            if method == 'POST' and target == '/predict':
+                try:
+                    text = json.loads(body)['text']
+                    if not isinstance(text, str):
+                        raise TypeError('"text" must be a string')
+                except (ValueError, KeyError, TypeError) as error:
+                    await send_http_response(writer, '400 Bad Request', {'error': str(error)})
+                    continue
+                try:
+                    probabilities = await batcher.predict(text)
+                    label = int(np.argmax(probabilities))
+                    status, payload = '200 OK', {'label': label, 'probabilities': probabilities}
+                except Exception as error:
+                    status, payload = '500 Internal Server Error', {'error': str(error)}
+            elif method == 'GET' and target == '/metrics':
+                status, payload = '200 OK', batcher.metrics()
+            else:
+                status, payload = '404 Not Found', {'error': 'unknown endpoint'}
+            await send_http_response(writer, status, payload)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+class PredictionServer:
+    # Local HTTP prediction service around a fitted or loaded classifier. It runs its own event loop in a
+    # background thread, so it can be started from a notebook whose loop is already running
+    def __init__(self, classifier, host='127.0.0.1', port=8000, max_batch_size=SERVER_MAX_BATCH_SIZE,
+                 max_wait_ms=SERVER_MAX_WAIT_MS):
+        self.classifier = classifier
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+        print("Serving {} on http://{}:{}".format(self.classifier.model_name, self.host, self.port))
+        return self
+
+    async def serve(self):
+        self.batcher = MicroBatcher(self.classifier, self.max_batch_size, self.max_wait_ms)
+        self.batch_task = asyncio.create_task(self.batcher.run())
+        self.server = await asyncio.start_server(lambda reader, writer: handle_http_connection(reader, writer, self.batcher),
+                                                 self.host, self.port)
+        # Port 0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def shutdown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batch_task.cancel()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.batcher.executor.shutdown()
+
+async def load_client(host, port, texts, latencies, errors):
+    # One keep-alive connection sending its requests one after another; the status lines of non-200
+    # responses are collected in errors
+    reader, writer = await asyncio.open_connection(host, port)
+    for text in texts:
+        body = json.dumps({'text': text}).encode()
+        start = time.perf_counter()
+        writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+            host, len(body)).encode() + body)
+        await writer.drain()
+        status_line = (await reader.readline()).decode().strip()
+        if status_line.split(' ', 2)[1:2] != ['200']:
+            errors.append(status_line)
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+def run_load_test(host, port, texts, concurrency=32, n_requests=2000):
+    # Closed-loop load from concurrency clients, then the client-side latencies next to the server's metrics
+    texts = list(texts)
+    requests = [texts[i % len(texts)] for i in range(n_requests)]
+    latencies = []
+    errors = []
+
+    async def generate():
+        start = time.perf_counter()
+        await asyncio.gather(*(load_client(host, port, requests[client::concurrency], latencies, errors)
+                               for client in range(concurrency)))
+        return time.perf_counter() - start
+
+    # The clients get their own event loop, as the notebook's may already be running
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        seconds = pool.submit(asyncio.run, generate()).result()
+    with urllib.request.urlopen('http://{}:{}/metrics'.format(host, port)) as response:
+        server_metrics = json.load(response)
+    latencies = np.array(latencies) * 1000
+    results = {'requests': len(latencies), 'errors': len(errors), 'requests_per_sec': len(latencies) / seconds,
+               'latency_p50_ms': float(np.percentile(latencies, 50)), 'latency_p99_ms': float(np.percentile(latencies, 99)),
+               'server': server_metrics}
+    print("{} requests from {} clients, {} errors: {:.0f} requests/sec, p50 {:.1f} ms, p99 {:.1f} ms, mean batch {:.1f}".format(
+        results['requests'], concurrency, results['errors'], results['requests_per_sec'], results['latency_p50_ms'],
+        results['latency_p99_ms'], server_metrics['mean_batch_size']))
+    if errors:
+        print("First error response: {}".format(errors[0]))
+    return results
+
+def make_pruner(name=PRUNER):
+    # Optuna pruners compare the per-epoch values reported by the objectives (epochs are the resource)
+    if name == 'median':
+        return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=1)
+    if name == 'successive_halving':
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=3)
+    if name == 'hyperband':
+        return optuna.pruners.HyperbandPruner(min_resource=1, max_resource=5, reduction_factor=3)
+    if name is None:
+        return optuna.pruners.NopPruner()
+    raise ValueError("Unknown pruner: {}".format(name))
+
+def save_trial_checkpoint(trial, model, value, top_k=CHECKPOINT_TOP_K, checkpoint_dir=CHECKPOINT_DIR):
+    # Save the weights a trial finished with, then delete all but the top_k best checkpoints of its study
+    if not top_k:
+        return None
+    root = os.path.join(checkpoint_dir, trial.study.study_name)
+    path = os.path.join(root, 'trial-{}'.format(trial.number))
+    model.save_pretrained(path)
+    # value.json is written last, so checkpoints still being saved are never ranked
+    with open(os.path.join(path, 'value.json'), 'w') as f:
+        json.dump({'value': value}, f)
+    trial.set_user_attr('checkpoint', path)
+
+    # Study workers share the directory, so ranking and deleting happen under a lock
+    with open(os.path.join(root, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        values = {}
+        for value_path in glob.glob(os.path.join(root, 'trial-*', 'value.json')):
+            with open(value_path) as f:
+                values[os.path.dirname(value_path)] = json.load(f)['value']
+        # Ties go to the earlier trial, as they do for study.best_trial
+        ranked = sorted(values, key=lambda path: (-values[path], int(path.rsplit('-', 1)[1])))
+        for stale in ranked[top_k:]:
+            shutil.rmtree(stale, ignore_errors=True)
+    return path
+
+def best_trial_checkpoint(study):
+    # Checkpoint of the study's best trial, or None when it was not kept
+    path = study.best_trial.user_attrs.get('checkpoint')
+    return path if path and os.path.exists(os.path.join(path, 'value.json')) else None
+
+def open_study_storage(study_name, study_dir=STUDY_DIR):
+    # Append-only journal file shared by every worker process of the study
+    os.makedirs(study_dir, exist_ok=True)
+    path = os.path.join(study_dir, study_name + '.log')
+    journal = getattr(optuna.storages, 'journal', None)
+    if journal is not None and hasattr(journal, 'JournalFileBackend'):
+        backend = journal.JournalFileBackend(path, lock_obj=journal.JournalFileOpenLock(path))
+    else:
+        # Optuna < 4.0
+        backend = optuna.storages.JournalFileStorage(path, lock_obj=optuna.storages.JournalFileOpenLock(path))
+    return optuna.storages.JournalStorage(backend)
+
+def split_cores(n_workers):
+    # Contiguous, non-overlapping slices of the cores this process may run on
+    # (with more workers than cores, each worker gets one core shared round-robin)
+    cores = sorted(os.sched_getaffinity(0))
+    if n_workers > len(cores):
+        return [[cores[i % len(cores)]] for i in range(n_workers)]
+    return [[int(core) for core in chunk] for chunk in np.array_split(cores, n_workers)]
+
+def count_finished_trials(study):
+    return len(study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE,
+                                                        optuna.trial.TrialState.PRUNED)))
+
+def run_study_worker(study_name, objective, n_trials, cores, study_dir=STUDY_DIR):
+    # Keep torch's intra-op threads, the tokenizer threads (when this worker creates their pool, see
+    # set_tokenizer_threads) and the DataLoader workers forked from here on this worker's cores
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    set_tokenizer_threads(cores)
+    study = optuna.load_study(study_name=study_name, storage=open_study_storage(study_name, study_dir),
+                              pruner=make_pruner())
+    if count_finished_trials(study) >= n_trials:
+        return
+    # Every worker stops once the study as a whole has n_trials finished trials
+    study.optimize(profile_trial(objective, study_name, study_dir), callbacks=[optuna.study.MaxTrialsCallback(
+        n_trials, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED))])
+
+def run_study(objective, study_name, n_trials=100, n_workers=STUDY_WORKERS, study_dir=STUDY_DIR):
+    # Create or resume the study, then run n_trials finished trials in total across n_workers processes
+    storage = open_study_storage(study_name, study_dir)
+    study = optuna.create_study(study_name=study_name, storage=storage, direction='maximize',
+                                pruner=make_pruner(), load_if_exists=True)
+
+    # Trials left running by a dead kernel will never finish; fail them and queue their parameters again
+    for trial in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.RUNNING,)):
+        storage.set_trial_state_values(trial._trial_id, optuna.trial.TrialState.FAIL)
+        study.enqueue_trial(trial.params, skip_if_exists=True)
+    print("Study {}: {} of {} trials finished".format(study_name, count_finished_trials(study), n_trials))
+
+    if n_workers == 1:
+        # Stay in this process so an already initialized CUDA context keeps working
+        run_study_worker(study_name, objective, n_trials, sorted(os.sched_getaffinity(0)), study_dir)
+    else:
+        # Forked workers inherit the objective and the data it reads from module globals
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=run_study_worker, args=(study_name, objective, n_trials, cores, study_dir))
+                     for cores in split_cores(n_workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [process.exitcode for process in processes if process.exitcode != 0]
+        if failed:
+            raise RuntimeError("{} study workers exited with codes {}".format(len(failed), failed))
+
+    return optuna.load_study(study_name=study_name, storage=storage)
+
+def benchmark_study_workers(objective, worker_counts=(1, 2, 4), n_trials=8, study_dir=STUDY_DIR):
+    # Trials/hour of fresh studies run with an increasing number of worker processes (CPU only)
+    results = {}
+    for n_workers in worker_counts:
+        study_name = 'benchmark-{}-workers-{}'.format(n_workers, int(time.time()))
+        start = time.perf_counter()
+        study = run_study(objective, study_name, n_trials=n_trials, n_workers=n_workers, study_dir=study_dir)
+        elapsed = time.perf_counter() - start
+        results[n_workers] = count_finished_trials(study) / elapsed * 3600
+        print("{} workers: {:.1f}s for {} trials, {:.1f} trials/hour ({:.2f}x)".format(
+            n_workers, elapsed, count_finished_trials(study), results[n_workers],
+            results[n_workers] / results[worker_counts[0]]))
+    return results
+
+# Custom BERT classifier engine; every backbone shares its tokenization, caching, batching and training loop
+class BERTClassifier(BaseEstimator, ClassifierMixin):
+    def __init__(self, model_name='bert-base-uncased', lr=2e-5, epochs=3, batch_size=32, early_stopping=True, patience=3,
+                 bucket_by_length=True, max_tokens=None, trainable_layers=None, deduplicate=False, num_labels=2,
+                 eval_every=None, eval_subsample=None, restore_best=True, warm_start=None, precision='fp32',
+                 accumulation_steps=1, cache_dir=CACHE_DIR):
+        self.model_name = model_name
+        self.lr = lr
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.early_stopping = early_stopping
+        self.patience = patience
+        self.bucket_by_length = bucket_by_length
+        self.max_tokens = max_tokens
+        self.trainable_layers = trainable_layers
+        self.deduplicate = deduplicate
+        self.num_labels = num_labels
+        self.eval_every = eval_every
+        self.eval_subsample = eval_subsample
+        self.restore_best = restore_best
+        self.warm_start = warm_start
+        self.precision = precision
+        self.accumulation_steps = accumulation_steps
+        self.cache_dir = cache_dir
+
+    def fit(self, X, y, X_val=None, y_val=None, trial=None):
+        # Cached encoder features are keyed by backbone, so they must come from the pretrained weights
+        if self.trainable_layers is not None and self.warm_start is not None:
+            raise ValueError("trainable_layers cannot be combined with warm_start: the frozen-encoder feature cache "
+                             "holds features of the pretrained {} weights".format(self.model_name))
+        # Labels are the model's output columns, which predict returns the argmax of, whether or not y covers them all
+        self.classes_ = list(range(self.num_labels))
+        if self.warm_start is None:
+            self.model = load_pretrained_model(self.model_name, num_labels=self.num_labels)
+        else:
+            # Continue from saved weights, such as the best trial's checkpoint, instead of the pretrained backbone
+            self.model = BertForSequenceClassification.from_pretrained(self.warm_start)
+        self.tokenizer = load_tokenizer(self.model_name)
+        if self.trainable_layers is None:
+            self.optimizer = AdamW(self.model.parameters(), lr=self.lr)
+        else:
+            self.optimizer = AdamW(freeze_encoder(self.model, self.trainable_layers), lr=self.lr)
+
+        # Repeated (text, label) rows collapse into one example whose loss counts once per row
+        if self.deduplicate:
+            examples, counts, _ = deduplicate_examples(X["text"], y)
+            texts, labels, weights = examples['text'], torch.tensor(examples['label'].tolist()), torch.tensor(counts, dtype=torch.float32)
+        else:
+            texts, labels, weights = X["text"], torch.tensor(y.tolist()), torch.ones(len(y))
+
+        # Tokenize text data and prepare input tensors
+        inputs = self.encode(texts)
+        lengths = inputs['attention_mask'].sum(dim=1).numpy()
+
+        # The validation set (needed for early stopping and pruning) is tokenized and batched once
+        validation = None if X_val is None else self.prepare_evaluation(X_val, y_val, self.eval_subsample)
+        best_val_loss = float('inf')
+        best_weights = None
+        patience_counter = 0
+        evaluations = 0
+
+        def validate():
+            # Score the validation set, report it to Optuna and return True once training should stop
+            nonlocal best_val_loss, best_weights, patience_counter, evaluations
+            with profile_phase('eval', len(validation['labels']), int(validation['inputs']['attention_mask'].sum())):
+                val_loss, val_accuracy = self.evaluate_prepared(validation)
+            self.model.train()
+
+            # Report to Optuna and abandon trials the pruner considers unpromising
+            if trial is not None:
+                trial.report(val_accuracy, evaluations)
+                trial.set_user_attr('val_loss_{}'.format(evaluations), val_loss)
+                if trial.should_prune():
+                    raise optuna.TrialPruned()
+            evaluations += 1
+
+            # Keep an in-memory copy of the trainable weights that scored best so far
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                patience_counter = 0
+                if self.restore_best:
+                    best_weights = {name: parameter.detach().clone() for name, parameter in self.model.named_parameters()
+                                    if parameter.requires_grad}
+                return False
+            patience_counter += 1
+            return self.early_stopping and patience_counter >= self.patience
+
+        # Train the model, validating every eval_every optimizer steps or else after each epoch
+        step = 0
+        stopped = False
+        for epoch in range(self.epochs):
+            self.model.train()
+            running_loss = 0.0
+            for batch in make_batches(lengths, self.batch_size, bucket=self.bucket_by_length, shuffle=self.bucket_by_length):
+                # Accumulate the gradients of the batch over accumulation_steps micro-batches, each weighted
+                # against the whole batch so one optimizer step sees the gradient of the full batch
+                self.optimizer.zero_grad()
+                batch_weight = weights[batch].sum()
+                for micro_batch in np.array_split(batch, min(self.accumulation_steps, len(batch))):
+                    with profile_phase('forward', len(micro_batch), int(lengths[micro_batch].sum())):
+                        with autocast_context(self.precision):
+                            outputs = self.forward(inputs, micro_batch)
+                        loss = weighted_loss(outputs.logits, labels[micro_batch], weights[micro_batch], total_weight=batch_weight)
+                    with profile_phase('backward', len(micro_batch)):
+                        loss.backward()
+                    running_loss += loss.item()
+                with profile_phase('optimizer_step'):
+                    self.optimizer.step()
+
+                step += 1
+                if validation is not None and self.eval_every and step % self.eval_every == 0:
+                    stopped = validate()
+                    if stopped:
+                        break
+
+            if validation is not None and not self.eval_every and not stopped:
+                stopped = validate()
+
+            # Early stopping
+            if stopped:
+                print("Early stopping after {} epochs.".format(epoch + 1))
+                break
+
+        # Finish with the weights that scored best on the validation set
+        if best_weights is not None:
+            self.model.load_state_dict(best_weights, strict=False)
+        return self
+
+    def encode(self, texts):
+        # Token ids, or the rows of cached frozen-encoder features when only the top layers are trained
+        inputs = encode_texts(self.tokenizer, self.model_name, texts, max_length=128, cache_dir=self.cache_dir)
+        if self.trainable_layers is not None:
+            inputs['features'], inputs['rows'] = lookup_feature_rows(self.model, self.tokenizer, self.model_name, texts,
+                                                                     self.trainable_layers, max_length=128,
+                                                                     cache_dir=self.cache_dir)
+        return inputs
+
+    def forward(self, inputs, batch, labels=None):
+        if self.trainable_layers is None:
+            return self.model(**select_batch(inputs, batch), labels=labels)
+        return classify_features(self.model, gather_features(inputs['features'], inputs['rows'][batch]),
+                                 self.trainable_layers, labels)
+
+    def score_chunk(self, texts, return_logits=False):
+        # Class probabilities (or logits) of a bounded chunk of texts, scoring each unique text once;
+        # batches may be reordered by length, so scores are written back by index
+        examples, _, inverse = deduplicate_examples(texts)
+        inputs = self.encode(examples['text'])
+        lengths = inputs['attention_mask'].sum(dim=1).numpy()
+
+        self.model.eval()
+        scores = np.zeros((len(lengths), self.num_labels), dtype=np.float32)
+        latencies = []
+        with torch.inference_mode(), profile_phase('predict', len(lengths), int(lengths.sum())):
+            for batch in make_batches(lengths, self.batch_size, bucket=self.bucket_by_length, max_tokens=self.max_tokens):
+                start = time.perf_counter()
+                logits = self.forward(inputs, batch).logits
+                scores[batch] = (logits if return_logits else logits.softmax(dim=1)).cpu().numpy()
+                latencies.append(time.perf_counter() - start)
+        return scores[inverse], latencies
+
+    def predict_stream(self, chunks, output=None, output_path=None, return_logits=False):
+        # Score a DataFrame, or any iterable of DataFrames / Arrow record batches with a "text" column
+        # (e.g. pd.read_csv(..., chunksize=n) or ParquetFile.iter_batches()), one bounded chunk at a time.
+        # Scores go into the preallocated output array, or are appended to output_path and returned
+        # memory-mapped; throughput and per-batch latency are left in predict_stats_
+        # A lazily loaded artifact reads its weights on first use
+        if self.model is None:
+            self.model = BertForSequenceClassification.from_pretrained(self.artifact_path_)
+        if isinstance(chunks, pd.DataFrame):
+            frame = chunks
+            chunks = (frame.iloc[start:start + PREDICT_CHUNK_ROWS] for start in range(0, len(frame), PREDICT_CHUNK_ROWS))
+        rows = 0
+        parts = []
+        latencies = []
+        start = time.perf_counter()
+        with (open(output_path, 'wb') if output_path else contextlib.nullcontext()) as f:
+            for chunk in chunks:
+                if hasattr(chunk, 'to_pandas'):
+                    chunk = chunk.to_pandas()
+                scores, chunk_latencies = self.score_chunk(chunk["text"], return_logits)
+                if output is not None:
+                    output[rows:rows + len(scores)] = scores
+                elif f is not None:
+                    f.write(scores.tobytes())
+                else:
+                    parts.append(scores)
+                rows += len(scores)
+                latencies.extend(chunk_latencies)
+        seconds = time.perf_counter() - start
+        self.predict_stats_ = {'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / seconds if seconds else 0.0,
+                               'batches': len(latencies),
+                               'batch_latency_p50_ms': float(np.percentile(latencies, 50)) * 1000 if latencies else 0.0,
+                               'batch_latency_p95_ms': float(np.percentile(latencies, 95)) * 1000 if latencies else 0.0}
+
+        if output is not None:
+            return output[:rows]
+        if output_path and rows:
+            return np.memmap(output_path, dtype=np.float32, mode='r', shape=(rows, self.num_labels))
+        return np.concatenate(parts) if parts else np.zeros((0, self.num_labels), dtype=np.float32)
+
+    def predict_proba(self, X):
+        return self.predict_stream(X)
+
+    def predict(self, X):
+        return self.predict_stream(X).argmax(axis=1).tolist()
+
+    def prepare_evaluation(self, X, y, subsample=None):
+        # Tokenize and batch an evaluation set once; each unique (text, label) pair is scored once and
+        # weighted by its count. A subsample is drawn with a fixed seed so scores stay comparable
+        if subsample is not None and len(X) > subsample:
+            rows = np.random.RandomState(42).choice(len(X), subsample, replace=False)
+            X, y = X.iloc[rows], y.iloc[rows]
+        examples, counts, _ = deduplicate_examples(X["text"], y)
+        inputs = self.encode(examples['text'])
+        lengths = inputs['attention_mask'].sum(dim=1).numpy()
+        return {'inputs': inputs, 'labels': torch.tensor(examples['label'].tolist()),
+                'weights': torch.tensor(counts, dtype=torch.float32),
+                'batches': make_batches(lengths, self.batch_size, bucket=self.bucket_by_length, max_tokens=self.max_tokens)}
+
+    def evaluate_prepared(self, evaluation):
+        # Mean loss and accuracy over the rows of a prepared evaluation set
+        inputs, labels, weights = evaluation['inputs'], evaluation['labels'], evaluation['weights']
+        self.model.eval()
+        total_loss = 0.0
+        correct = 0
+        with torch.inference_mode():
+            for batch in evaluation['batches']:
+                outputs = self.forward(inputs, batch)
+                loss = weighted_loss(outputs.logits, labels[batch], weights[batch])
+                total_loss += loss.item() * weights[batch].sum().item()
+                correct += (weights[batch] * (outputs.logits.argmax(dim=1) == labels[batch])).sum().item()
+
+        return total_loss / weights.sum().item(), correct / weights.sum().item()
+
+    def evaluate(self, X, y):
+        return self.evaluate_prepared(self.prepare_evaluation(X, y))
+
+    def evaluate_loss(self, X, y):
+        return self.evaluate(X, y)[0]
+
+def load_data():
+    # Mount Google Drive
+    drive.mount('/content/drive')
+
+    # Load the DataFrames
+    folder_path = '/content/drive/My Drive/Hs/'
+
+    # Feature Engineering
+    short_threshold = 2.0
+    medium_threshold = 5.0
+    columns_to_drop = ['deathtime', 'admit_provider_id', 'dod', 'los', 'language', 'seq_num', 'insurance']
+
+    # Merge, categorize and clean the datasets, reusing the cached cohort while nothing above changes
+    with profile_phase('load_data') as phase:
+        merged_data = load_cohort(folder_path, clean_text=True, short_threshold=short_threshold,
+                                  medium_threshold=medium_threshold, columns_to_drop=columns_to_drop)
+        phase['samples'] = len(merged_data)
+
+    return merged_data
+
+# Row-wise reference for normalize_titles(titles) as used by load_data above
 def preprocess_text(text):
     # Remove punctuation using regex
     text = re.sub(r'[^\w\s]', '', text)
@@ -83,56 +1846,314 @@ def objective(trial):
     batch_size = trial.suggest_categorical('batch_size', [16, 32, 64])
 
     # Initialize BERT tokenizer and model
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    model = BertForSequenceClassification.from_pretrained('bert-base-uncased', num_labels=3)  # Adjust for 3 classes
+    tokenizer = load_tokenizer(BACKBONES['bert-base-uncased'])
+    model = load_pretrained_model(BACKBONES['bert-base-uncased'], num_labels=3)  # Adjust for 3 classes
 
     # Define optimizer
     optimizer = AdamW(model.parameters(), lr=lr)
 
-    # Split data into train, validation, and test sets
-    X_train_val, X_test, y_train_val, y_test = train_test_split(X, y, test_size=0.1, random_state=42)
-    X_train, X_val, y_train, y_val = train_test_split(X_train_val, y_train_val, test_size=0.111, random_state=42)  # 80% train, 10% validation, 10% test
-
-    # Tokenize input data
-    train_encodings = tokenizer(X_train["text"].tolist(), padding=True, truncation=True, return_tensors='pt')
-    val_encodings = tokenizer(X_val["text"].tolist(), padding=True, truncation=True, return_tensors='pt')
-
-    # Convert labels to tensors
-    train_labels = torch.tensor(y_train.tolist())
-    val_labels = torch.tensor(y_val.tolist())
+    # Tokenize input data into shuffled, length-bucketed mini-batches (truncated at 512 tokens, the longest
+    # input bert-base-uncased accepts); ACCUMULATION_STEPS of them make up one batch of the sampled size
+    train_loader = make_data_loader(tokenizer, BACKBONES['bert-base-uncased'], X_train["text"], y_train,
+                                    max(1, batch_size // ACCUMULATION_STEPS), shuffle=True, max_length=512)
+    val_loader = make_data_loader(tokenizer, BACKBONES['bert-base-uncased'], X_val["text"], y_val, batch_size,
+                                  max_length=512)
 
     # Train the model
+    n_steps = len(train_loader)
     for epoch in range(epochs):
         model.train()
         optimizer.zero_grad()
-
-        # Forward pass
-        train_outputs = model(**train_encodings, labels=train_labels)
-        train_loss = train_outputs.loss
-
-        # Backward pass
-        train_loss.backward()
-        optimizer.step()
+        for step, (_, input_batch, label_batch) in enumerate(train_loader, 1):
+            # Forward pass
+            with profile_phase('forward', len(label_batch), int(input_batch['attention_mask'].sum())):
+                with autocast_context(TRAIN_PRECISION):
+                    train_outputs = model(**input_batch)
+                train_loss = torch.nn.functional.cross_entropy(train_outputs.logits.float(), label_batch) / ACCUMULATION_STEPS
+
+            # Backward pass, stepping once per ACCUMULATION_STEPS micro-batches
+            with profile_phase('backward', len(label_batch)):
+                train_loss.backward()
+            if step % ACCUMULATION_STEPS == 0 or step == n_steps:
+                with profile_phase('optimizer_step'):
+                    optimizer.step()
+                    optimizer.zero_grad()
 
         # Evaluation
-        model.eval()
-        with torch.no_grad():
-            val_outputs = model(**val_encodings)
-            val_predictions = val_outputs.logits.argmax(dim=1)
-            val_accuracy = accuracy_score(val_labels, val_predictions)
+        with profile_phase('eval', len(y_val)):
+            val_predictions = predict_loader(model, val_loader)
+        val_accuracy = accuracy_score(y_val, val_predictions)
 
+        # Report the epoch to Optuna and abandon trials the pruner considers unpromising
+        trial.report(val_accuracy, epoch)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+
+    # Keep the trial's weights for warm-starting the final fit
+    save_trial_checkpoint(trial, model, val_accuracy)
     return val_accuracy
 
+# Vocabulary of the synthetic diagnosis titles; the tiny benchmark BERT's WordPiece vocabulary is built
+# from the same words, so its token ids do not depend on the generated scale
+SYNTHETIC_QUALIFIERS = ['Acute', 'Chronic', 'Unspecified', 'Other', 'Malignant', 'Benign', 'Severe', 'Recurrent',
+                        'Congenital', 'Secondary']
+SYNTHETIC_CONDITIONS = ['sepsis', 'pneumonia', 'hypertension', 'diabetes mellitus', 'heart failure', 'kidney disease',
+                        'anemia', 'fracture', 'hemorrhage', 'infection', 'obstruction', 'neoplasm', 'embolism',
+                        'arrhythmia', 'respiratory failure', 'cardiac arrest', 'hyperlipidemia', 'depression',
+                        'cirrhosis', 'ulcer']
+SYNTHETIC_SITES = ['liver', 'lung', 'kidney', 'heart', 'brain', 'colon', 'stomach', 'pancreas', 'bladder', 'skin',
+                   'femur', 'spine']
+SYNTHETIC_SUFFIXES = ['with complications', 'without complications', 'initial encounter', 'subsequent encounter',
+                      'due to other causes', 'not elsewhere classified']
+# Diagnoses that raise the in-hospital mortality (hospital_expire_flag) of an admission
+SYNTHETIC_FATAL_CONDITIONS = ['sepsis', 'respiratory failure', 'cardiac arrest', 'hemorrhage']
+
+def generate_synthetic_mimic(folder_path, n_patients=1000, admissions_per_patient=2.0, icu_fraction=0.5,
+                             diagnoses_per_admission=8.0, n_codes=2000, seed=0):
+    # Write admissions, patients, icustays, diagnoses_icd and d_icd_diagnoses csv files with the columns,
+    # id ranges, value sets and missingness of MIMIC-IV at the given scale, for running the pipeline
+    # without the credentialed files; diagnoses are sorted by subject_id like the real table
+    rng = np.random.RandomState(seed)
+    os.makedirs(folder_path, exist_ok=True)
+
+    # Diagnosis dictionary: half ICD-9 codes, half ICD-10 codes, with titles composed from the vocabulary
+    n_icd9 = n_codes // 2
+    icd_codes = np.concatenate([np.char.mod('%05d', np.arange(n_icd9)),
+                                np.char.add(np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))[np.arange(n_codes - n_icd9) % 26],
+                                            np.char.mod('%04d', np.arange(n_codes - n_icd9)))])
+    icd_versions = np.where(np.arange(n_codes) < n_icd9, 9, 10)
+    conditions = rng.randint(len(SYNTHETIC_CONDITIONS), size=n_codes)
+    second = rng.randint(len(SYNTHETIC_CONDITIONS), size=n_codes)
+    titles = pd.Series(np.array(SYNTHETIC_QUALIFIERS)[rng.randint(len(SYNTHETIC_QUALIFIERS), size=n_codes)])
+    titles = titles + ' ' + np.array(SYNTHETIC_CONDITIONS)[conditions]
+    titles = titles.where(rng.rand(n_codes) < 0.7, titles + np.where(rng.rand(n_codes) < 0.5, ' and ', ' or ')
+                          + np.array(SYNTHETIC_CONDITIONS)[second])
+    titles = titles + ' of ' + np.array(SYNTHETIC_SITES)[rng.randint(len(SYNTHETIC_SITES), size=n_codes)]
+    titles = titles.where(rng.rand(n_codes) < 0.5, titles + ', ' + np.array(SYNTHETIC_SUFFIXES)[
+        rng.randint(len(SYNTHETIC_SUFFIXES), size=n_codes)])
+    titles = titles.where(rng.rand(n_codes) < 0.8, titles + ' (stage ' + pd.Series(rng.randint(1, 6, size=n_codes)).astype(str) + ')')
+    fatal = np.isin(np.array(SYNTHETIC_CONDITIONS)[conditions], SYNTHETIC_FATAL_CONDITIONS)
+    pd.DataFrame({'icd_code': icd_codes, 'icd_version': icd_versions, 'long_title': titles}).to_csv(
+        folder_path + 'd_icd_diagnoses.csv', index=False)
+
+    # Patients
+    subject_ids = 10000000 + np.arange(n_patients)
+    anchor_years = rng.randint(2110, 2190, size=n_patients)
+    patients = pd.DataFrame({'subject_id': subject_ids, 'gender': rng.choice(['F', 'M'], size=n_patients),
+                             'anchor_age': rng.randint(18, 92, size=n_patients), 'anchor_year': anchor_years,
+                             'anchor_year_group': rng.choice(['2008 - 2010', '2011 - 2013', '2014 - 2016', '2017 - 2019',
+                                                              '2020 - 2022'], size=n_patients)})
+
+    # Admissions, each with its diagnoses drawn from a skewed code distribution
+    per_patient = 1 + rng.poisson(max(admissions_per_patient - 1, 0), size=n_patients)
+    admission_subjects = np.repeat(subject_ids, per_patient)
+    n_admissions = len(admission_subjects)
+    hadm_ids = 20000000 + rng.permutation(n_admissions)
+    per_admission = np.maximum(rng.poisson(diagnoses_per_admission, size=n_admissions), 1)
+    code_weights = 1.0 / np.arange(1, n_codes + 1)
+    diagnosis_codes = rng.choice(n_codes, size=per_admission.sum(), p=code_weights / code_weights.sum())
+    diagnosis_admissions = np.repeat(np.arange(n_admissions), per_admission)
+    has_fatal = np.bincount(diagnosis_admissions, weights=fatal[diagnosis_codes], minlength=n_admissions) > 0
+    died = rng.rand(n_admissions) < np.where(has_fatal, 0.3, 0.05)
+
+    admittime = pd.to_datetime(np.repeat(anchor_years, per_patient).astype(str)) + pd.to_timedelta(
+        np.round(rng.rand(n_admissions) * 365 * 1440), unit='m')
+    hospital_days = rng.exponential(6.0, size=n_admissions) + 0.5
+    dischtime = admittime + pd.to_timedelta(np.round(hospital_days * 1440), unit='m')
+    emergency = rng.rand(n_admissions) < 0.6
+    admissions = pd.DataFrame({
+        'subject_id': admission_subjects, 'hadm_id': hadm_ids, 'admittime': admittime, 'dischtime': dischtime,
+        'deathtime': dischtime.where(died),
+        'admission_type': np.where(emergency, rng.choice(['EW EMER.', 'URGENT', 'DIRECT EMER.'], size=n_admissions),
+                                   rng.choice(['ELECTIVE', 'OBSERVATION ADMIT', 'SURGICAL SAME DAY ADMISSION'], size=n_admissions)),
+        'admit_provider_id': np.char.add('P', np.char.mod('%05d', rng.randint(100000, size=n_admissions))),
+        'admission_location': rng.choice(['EMERGENCY ROOM', 'PHYSICIAN REFERRAL', 'TRANSFER FROM HOSPITAL',
+                                          'WALK-IN/SELF REFERRAL'], size=n_admissions),
+        'discharge_location': np.where(died, 'DIED', rng.choice(['HOME', 'HOME HEALTH CARE', 'SKILLED NURSING FACILITY',
+                                                                 'REHAB'], size=n_admissions)),
+        'insurance': rng.choice(['Medicare', 'Medicaid', 'Other'], size=n_admissions),
+        'language': rng.choice(['ENGLISH', '?'], size=n_admissions, p=[0.9, 0.1]),
+        'marital_status': pd.Series(rng.choice(['MARRIED', 'SINGLE', 'WIDOWED', 'DIVORCED'], size=n_admissions)).where(
+            rng.rand(n_admissions) > 0.05),
+        'race': rng.choice(['WHITE', 'BLACK/AFRICAN AMERICAN', 'HISPANIC/LATINO - PUERTO RICAN', 'ASIAN', 'OTHER',
+                            'UNKNOWN'], size=n_admissions),
+        'edregtime': (admittime - pd.Timedelta(hours=4)).where(emergency),
+        'edouttime': admittime.where(emergency),
+        'hospital_expire_flag': died.astype(int)})
+
+    # ICU stays within a share of the admissions
+    icu = np.flatnonzero(rng.rand(n_admissions) < icu_fraction)
+    los = np.minimum(rng.exponential(3.0, size=len(icu)) + 0.1, hospital_days[icu])
+    intime = admittime[icu] + pd.to_timedelta(np.round((hospital_days[icu] - los) * rng.rand(len(icu)) * 1440), unit='m')
+    careunits = ['Medical Intensive Care Unit (MICU)', 'Surgical Intensive Care Unit (SICU)',
+                 'Cardiac Vascular Intensive Care Unit (CVICU)', 'Coronary Care Unit (CCU)', 'Trauma SICU (TSICU)',
+                 'Neuro Intermediate']
+    first_careunit = rng.choice(careunits, size=len(icu))
+    icustays = pd.DataFrame({'subject_id': admission_subjects[icu], 'hadm_id': hadm_ids[icu],
+                             'stay_id': 30000000 + np.arange(len(icu)), 'first_careunit': first_careunit,
+                             'last_careunit': np.where(rng.rand(len(icu)) < 0.85, first_careunit,
+                                                       rng.choice(careunits, size=len(icu))),
+                             'intime': intime, 'outtime': intime + pd.to_timedelta(np.round(los * 1440), unit='m'),
+                             'los': np.round(los, 4)})
+
+    # Patients who died in hospital get a date of death
+    death_dates = admissions.loc[died, ['subject_id', 'dischtime']].groupby('subject_id')['dischtime'].max().dt.date
+    patients['dod'] = patients['subject_id'].map(death_dates)
+
+    diagnoses_icd = pd.DataFrame({'subject_id': admission_subjects[diagnosis_admissions],
+                                  'hadm_id': hadm_ids[diagnosis_admissions],
+                                  'seq_num': np.arange(len(diagnosis_admissions)) - np.repeat(np.cumsum(per_admission) - per_admission, per_admission) + 1,
+                                  'icd_code': icd_codes[diagnosis_codes], 'icd_version': icd_versions[diagnosis_codes]})
+
+    tables = {'admissions': admissions, 'patients': patients, 'icustays': icustays, 'diagnoses_icd': diagnoses_icd}
+    for name, table in tables.items():
+        table.to_csv(folder_path + name + '.csv', index=False)
+    return dict({name: len(table) for name, table in tables.items()}, d_icd_diagnoses=n_codes)
+
+def make_tiny_bert(path, num_labels=2):
+    # A randomly initialized two-layer BERT with a WordPiece vocabulary covering the synthetic titles,
+    # saved like a hub checkpoint so the classifiers and caches use it by path, without network access
+    if os.path.exists(os.path.join(path, 'config.json')):
+        return path
+    os.makedirs(path, exist_ok=True)
+    words = ' '.join(SYNTHETIC_QUALIFIERS + SYNTHETIC_CONDITIONS + SYNTHETIC_SITES + SYNTHETIC_SUFFIXES + ['and', 'or', 'of', 'stage'])
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(set(words.lower().split())) + list('0123456789,()')
+    with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+    BertTokenizerFast(vocab_file=os.path.join(path, 'vocab.txt'), do_lower_case=True).save_pretrained(path)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, max_position_embeddings=512, num_labels=num_labels)
+    BertForSequenceClassification(config).save_pretrained(path)
+    return path
+
+def current_commit():
+    # Commit checked out in the working directory, or None outside a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark_suite(text_preprocessor, n_patients=2000, fit_rows=2000, seed=0, benchmark_dir=BENCHMARK_DIR,
+                        results_path=BENCHMARK_RESULTS, tolerance=BENCHMARK_TOLERANCE):
+    # Time csv ingestion, the cohort merge, text preprocessing, tokenization, one fit epoch and predict
+    # on synthetic MIMIC-IV data with a tiny local BERT (CPU only, no network or Drive access; the data, model
+    # and caches live under benchmark_dir), append the results to results_path and report phases that got
+    # slower than at the previously recorded commit
+    folder_path = os.path.join(benchmark_dir, 'mimic-{}-{}'.format(n_patients, seed)) + '/'
+    if not os.path.exists(folder_path + 'diagnoses_icd.csv'):
+        generate_synthetic_mimic(folder_path, n_patients, seed=seed)
+    model_dir = make_tiny_bert(os.path.join(benchmark_dir, 'tiny-bert'))
+    tokenizer = load_tokenizer(model_dir)
+    columns_to_drop = ['deathtime', 'admit_provider_id', 'dod', 'los', 'language', 'seq_num', 'insurance']
+    results = {}
+
+    def record(phase, seconds, rows):
+        results[phase] = {'seconds': seconds, 'rows': rows, 'rows_per_sec': rows / seconds if seconds else 0.0}
+
+    # Cold conversion and token caches, so every run measures the same work
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        for name in MIMIC_DTYPES:
+            convert_table(folder_path, name, cache_dir)
+        record('ingest', time.perf_counter() - start,
+               sum(pq.ParquetFile(convert_table(folder_path, name, cache_dir)).metadata.num_rows for name in MIMIC_DTYPES))
+
+        start = time.perf_counter()
+        cohort = build_cohort(folder_path, short_threshold=2.0, medium_threshold=5.0, columns_to_drop=columns_to_drop,
+                              cache_dir=cache_dir)
+        record('merge', time.perf_counter() - start, len(cohort))
+
+        apply_seconds, vectorized_seconds, mismatches = benchmark_preprocess_text(cohort['text'], text_preprocessor, repeats=1)
+        record('preprocess_text', apply_seconds, len(cohort))
+        record('normalize_titles', vectorized_seconds, len(cohort))
+
+        start = time.perf_counter()
+        encode_texts(tokenizer, model_dir, cohort['text'], cache_dir=cache_dir)
+        record('tokenize', time.perf_counter() - start, len(cohort))
+
+    # Training and prediction on a fixed sample, with its texts already in the token cache
+    sample = cohort.sample(min(fit_rows, len(cohort)), random_state=seed)
+    X, y = sample[['text']], sample['label']
+    cache_dir = os.path.join(benchmark_dir, 'cache')
+    encode_texts(tokenizer, model_dir, X['text'], cache_dir=cache_dir)
+    classifier = BERTClassifier(model_name=model_dir, epochs=1, early_stopping=False, cache_dir=cache_dir)
+    start = time.perf_counter()
+    classifier.fit(X, y)
+    record('fit_epoch', time.perf_counter() - start, len(X))
+    start = time.perf_counter()
+    classifier.predict_proba(X)
+    record('predict', time.perf_counter() - start, len(X))
+
+    run = {'commit': current_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'n_patients': n_patients,
+           'fit_rows': fit_rows, 'seed': seed, 'cpus': len(os.sched_getaffinity(0)), 'torch': torch.__version__,
+           'preprocess_mismatches': mismatches, 'results': results}
+
+    # Compare with the last run at the same scale on the same number of cores from another commit
+    baseline = None
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            for line in f:
+                previous = json.loads(line)
+                if all(previous[key] == run[key] for key in ('n_patients', 'fit_rows', 'seed', 'cpus')) and (
+                        run['commit'] is None or previous['commit'] != run['commit']):
+                    baseline = previous
+    regressions = {}
+    for phase, result in results.items():
+        before = baseline['results'].get(phase) if baseline else None
+        change = result['seconds'] / before['seconds'] if before and before['seconds'] else None
+        if change is not None and change > tolerance:
+            regressions[phase] = change
+        print("{:<17}{:>9.3f}s {:>12.0f} rows/sec{}".format(
+            phase, result['seconds'], result['rows_per_sec'],
+            '' if change is None else '  {:.2f}x vs {}{}'.format(change, (baseline['commit'] or '')[:10] or 'previous run',
+                                                                '  REGRESSION' if phase in regressions else '')))
+
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return run, regressions
+
+# Offline benchmark entry point: everything above only defines helpers, so the suite needs neither Drive nor
+# the MIMIC-IV files. Run it with --benchmark-suite from a checkout (as a .py without the !pip lines) or with
+# RUN_BENCHMARK_SUITE set in the notebook; either way it stops here instead of running the pipeline below
+RUN_BENCHMARK_SUITE = RUN_BENCHMARK_SUITE or '--benchmark-suite' in sys.argv[1:]
+if RUN_BENCHMARK_SUITE:
+    run_benchmark_suite(preprocess_text)
+    sys.exit(0)
+
 # Load data
 merged_df = load_data()
 
+# Compare peak memory of the in-memory and chunked cohort builds
+if RUN_BENCHMARKS:
+    compare_join_memory('/content/drive/My Drive/Hs/', clean_text=True, short_threshold=2.0,
+                        medium_threshold=5.0,
+                        columns_to_drop=['deathtime', 'admit_provider_id', 'dod', 'los', 'language', 'seq_num', 'insurance'])
+
+# Check the fast tokenizers against BertTokenizer and compare their throughput
+if RUN_BENCHMARKS:
+    check_tokenizer_parity(merged_df['text'].unique())
+    benchmark_tokenizers(merged_df['text'].unique())
+
+# Compare per-trial model setup with and without the pretrained model cache
+if RUN_BENCHMARKS:
+    benchmark_model_loading()
+
 # Split data into features (X) and target (y)
 X = merged_df.drop(columns=["label"])
 y = merged_df["label"]
 
-# Run hyperparameter optimization
-study = optuna.create_study(direction='maximize')
-study.optimize(objective, n_trials=100)
+# Split into train, validation, and test sets by patient, once for all trials (80% / 10% / 10%)
+splits = split_frames(X, y, grouped_split(merged_df))
+X_train, y_train = splits['train']
+X_val, y_val = splits['val']
+X_test, y_test = splits['test']
+
+# Compare trials/hour of the study with 1, 2 and 4 worker processes
+if RUN_BENCHMARKS:
+    benchmark_study_workers(objective)
+
+# Run (or resume) hyperparameter optimization
+study = run_study(objective, 'bert-base-uncased', n_trials=100)
 
 # Print best parameters and performance
 print("Best parameters found: ", study.best_params)
@@ -141,121 +2162,83 @@ print("Best accuracy on validation set: {:.4f}".format(study.best_value))
 # Get the best hyperparameters
 best_params = study.best_params
 
-# Reinitialize the model with the best hyperparameters
-best_tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-best_model = BertForSequenceClassification.from_pretrained('bert-base-uncased', num_labels=3)  # Adjust for 3 classes
+# Warm-start from the best trial's checkpoint when it was kept, otherwise reinitialize the model
+warm_start = best_trial_checkpoint(study)
+best_tokenizer = load_tokenizer(BACKBONES['bert-base-uncased'])
+if warm_start:
+    best_model = BertForSequenceClassification.from_pretrained(warm_start)
+else:
+    best_model = load_pretrained_model(BACKBONES['bert-base-uncased'], num_labels=3)  # Adjust for 3 classes
 
 # Define optimizer with best learning rate
 best_optimizer = AdamW(best_model.parameters(), lr=best_params['lr'])
 
-# Train the best model
-for epoch in range(best_params['epochs']):
+# Train the best model on the entire training and validation data, continuing from the best trial's
+# checkpoint when it was kept
+X_train_val, y_train_val = splits['train_val']
+train_loader = make_data_loader(best_tokenizer, BACKBONES['bert-base-uncased'], X_train_val["text"], y_train_val,
+                                max(1, best_params['batch_size'] // ACCUMULATION_STEPS), shuffle=True, max_length=512)
+n_steps = len(train_loader)
+for epoch in range(WARM_START_EPOCHS if warm_start else best_params['epochs']):
     best_model.train()
     best_optimizer.zero_grad()
+    for step, (_, input_batch, label_batch) in enumerate(train_loader, 1):
+        # Forward pass
+        with autocast_context(TRAIN_PRECISION):
+            train_outputs = best_model(**input_batch)
+        train_loss = torch.nn.functional.cross_entropy(train_outputs.logits.float(), label_batch) / ACCUMULATION_STEPS
 
-    # Forward pass
-    train_encodings = best_tokenizer(X_train["text"].tolist(), padding=True, truncation=True, return_tensors='pt')
-    train_labels = torch.tensor(y_train.tolist())
-    train_outputs = best_model(**train_encodings, labels=train_labels)
-    train_loss = train_outputs.loss
-
-    # Backward pass
-    train_loss.backward()
-    best_optimizer.step()
+        # Backward pass, stepping once per ACCUMULATION_STEPS micro-batches
+        train_loss.backward()
+        if step % ACCUMULATION_STEPS == 0 or step == n_steps:
+            best_optimizer.step()
+            best_optimizer.zero_grad()
 
 # Save the best model
-model_filename = "BERT_Model.pkl"
-torch.save(best_model.state_dict(), model_filename)
-print(f"Best model saved to {model_filename}")
+model_dir = "BERT_Model"
+save_artifact(best_model, best_tokenizer, model_dir, {'params': best_params, 'labels': sorted(y.unique().tolist()),
+                                                      'max_length': 512})
+print(f"Best model saved to {model_dir}")
 
 # Evaluate the best model on the test set
-test_encodings = best_tokenizer(X_test["text"].tolist(), padding=True, truncation=True, return_tensors='pt')
-test_labels = torch.tensor(y_test.tolist())
-best_model.eval()
-with torch.no_grad():
-    test_outputs = best_model(**test_encodings)
-    test_predictions = test_outputs.logits.argmax(dim=1)
-    print(classification_report(test_labels.numpy(), test_predictions.numpy()))
-
-# Custom BERT Classifier
-class ClinicaBERTClassifier(BaseEstimator, ClassifierMixin):
-    def __init__(self, model_name='emilyalsentzer/Bio_ClinicalBERT', lr=2e-5, epochs=3, batch_size=32, early_stopping=True, patience=3):
-        self.model_name = model_name
-        self.lr = lr
-        self.epochs = epochs
-        self.batch_size = batch_size
-        self.early_stopping = early_stopping
-        self.patience = patience
-
-    def fit(self, X, y):
-        self.model = BertForSequenceClassification.from_pretrained(self.model_name, num_labels=2)
-        self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
-        self.optimizer = AdamW(self.model.parameters(), lr=self.lr)
-        best_val_loss = float('inf')
-        patience_counter = 0
-
-        # Tokenize text data and prepare input tensors
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-        labels = torch.tensor(y.tolist())
-
-        # Train the model
-        for epoch in range(self.epochs):
-            self.model.train()
-            running_loss = 0.0
-            for i in range(0, len(labels), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                label_batch = labels[i:i+self.batch_size]
-
-                self.optimizer.zero_grad()
-                outputs = self.model(**input_batch, labels=label_batch)
-                loss = outputs.loss
-                loss.backward()
-                self.optimizer.step()
-
-                running_loss += loss.item()
-
-            # Early stopping
-            if self.early_stopping:
-                val_loss = self.evaluate_loss(X_val, y_val)
-                if val_loss < best_val_loss:
-                    best_val_loss = val_loss
-                    patience_counter = 0
-                else:
-                    patience_counter += 1
-                    if patience_counter >= self.patience:
-                        print("Early stopping after {} epochs.".format(epoch + 1))
-                        break
-
-    def predict(self, X):
-        # Tokenize text data and prepare input tensors
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-
-        # Evaluate the model
-        self.model.eval()
-        predictions = []
-        with torch.no_grad():
-            for i in range(0, len(inputs['input_ids']), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                outputs = self.model(**input_batch)
-                logits = outputs.logits
-                predictions.extend(logits.argmax(dim=1).cpu().tolist())
-        return predictions
-
-    def evaluate_loss(self, X, y):
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-        labels = torch.tensor(y.tolist())
-
-        self.model.eval()
-        total_loss = 0.0
-        with torch.no_grad():
-            for i in range(0, len(labels), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                label_batch = labels[i:i+self.batch_size]
-                outputs = self.model(**input_batch, labels=label_batch)
-                loss = outputs.loss
-                total_loss += loss.item()
-
-        return total_loss / (len(labels) / self.batch_size)
+test_loader = make_data_loader(best_tokenizer, BACKBONES['bert-base-uncased'], X_test["text"], y_test,
+                               best_params['batch_size'], max_length=512)
+test_predictions = predict_loader(best_model, test_loader)
+print(classification_report(y_test, test_predictions))
+
+# Export int8 TorchScript and ONNX versions for CPU serving and check them against the fp32 model
+export_paths = export_model(best_model, best_tokenizer, os.path.join(model_dir, 'model'), X_train["text"], max_length=512)
+compare_exports(best_model, best_tokenizer, BACKBONES['bert-base-uncased'], export_paths, X_test, y_test, max_length=512)
+
+def benchmark_backbones(X_train, y_train, X_eval, y_eval, backbones=BACKBONES, latency_samples=20, **params):
+    # Run every registered backbone through the same BERTClassifier pipeline and compare
+    # training time, batch throughput, single-text latency and accuracy side by side
+    params.setdefault('early_stopping', False)
+    results = []
+    for name, model_name in backbones.items():
+        classifier = BERTClassifier(model_name=model_name, **params)
+        start = time.perf_counter()
+        classifier.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        predictions = classifier.predict(X_eval)
+        predict_seconds = time.perf_counter() - start
+
+        latencies = []
+        for i in range(min(latency_samples, len(X_eval))):
+            start = time.perf_counter()
+            classifier.predict(X_eval.iloc[[i]])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        results.append({'backbone': name, 'fit_seconds': fit_seconds,
+                        'train_rows_per_sec': len(X_train) * classifier.epochs / fit_seconds,
+                        'predict_rows_per_sec': len(X_eval) / predict_seconds,
+                        'latency_p50_ms': np.percentile(latencies, 50), 'latency_p95_ms': np.percentile(latencies, 95),
+                        'accuracy': accuracy_score(y_eval, predictions)})
+    results = pd.DataFrame(results).set_index('backbone')
+    print(results.round(3).to_string())
+    return results
 
 # Define objective function for Optuna
 def objective(trial):
@@ -265,19 +2248,26 @@ def objective(trial):
     batch_size = trial.suggest_categorical('batch_size', [16, 32, 64])
 
     # Initialize ClinicaBERT Classifier with dynamically passed values
-    clinica_bert_classifier = ClinicaBERTClassifier(
-        model_name='emilyalsentzer/Bio_ClinicalBERT',
+    clinica_bert_classifier = BERTClassifier(
+        model_name=BACKBONES['clinicalbert'],
         lr=lr,
         epochs=epochs,
-        batch_size=batch_size
+        batch_size=batch_size,
+        trainable_layers=SEARCH_TRAINABLE_LAYERS,
+        deduplicate=SEARCH_DEDUPLICATE,
+        precision=TRAIN_PRECISION,
+        accumulation_steps=ACCUMULATION_STEPS
     )
 
     # Train the model
-    clinica_bert_classifier.fit(X_train, y_train)
+    clinica_bert_classifier.fit(X_train, y_train, X_val, y_val, trial=trial)
 
     # Evaluate using validation set
     predictions = clinica_bert_classifier.predict(X_val)
     accuracy = accuracy_score(y_val, predictions)
+
+    # Keep the trial's weights for warm-starting the final fit
+    save_trial_checkpoint(trial, clinica_bert_classifier.model, accuracy)
     return accuracy
 
 import re
@@ -286,7 +2276,10 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.preprocessing import LabelEncoder
+import os
+import time
+import multiprocessing
+import concurrent.futures
 
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.metrics import classification_report
@@ -295,11 +2288,20 @@ from joblib import dump
 import warnings
 import optuna
 import torch
-from transformers import BertTokenizer, BertForSequenceClassification, AdamW
+from transformers import BertTokenizer, BertTokenizerFast, BertForSequenceClassification, AdamW
 
 # Ignore warnings
 warnings.filterwarnings('ignore')
 
+# Define words to remove from diagnosis titles (converted to lowercase)
+WORDS_TO_REMOVE = {'and', 'or', 'unspecified', 'other'}
+
+# Charts are rendered to PNG files in CHART_DIR by up to CHART_WORKERS processes; the correlation matrix
+# is computed on a uniform sample of at most CORRELATION_SAMPLE_ROWS cohort rows
+CHART_DIR = 'charts/'
+CHART_WORKERS = 4
+CORRELATION_SAMPLE_ROWS = 100000
+
 def load_data():
 
     # Mount Google Drive
@@ -307,118 +2309,140 @@ def load_data():
 
     # Load the DataFrames
     folder_path = '/content/drive/My Drive/Hs/'
-    admissions = pd.read_csv(folder_path + 'admissions.csv')
-    patients = pd.read_csv(folder_path + 'patients.csv')
-    icustays = pd.read_csv(folder_path + 'icustays.csv')
-    diagnoses_icd = pd.read_csv(folder_path + 'diagnoses_icd.csv')
-    d_icd_diagnoses = pd.read_csv(folder_path + 'd_icd_diagnoses.csv')
-
-    # Merge datasets based on common columns using inner join
-    merged_data = pd.merge(admissions, patients, on='subject_id', how='inner')
-    merged_data = pd.merge(merged_data, icustays, on=['subject_id', 'hadm_id'], how='inner')
-    merged_data = pd.merge(merged_data, diagnoses_icd, on=['subject_id', 'hadm_id'], how='inner')
-    d_icd_diagnoses['long_title'] = d_icd_diagnoses['long_title'].apply(preprocess_text)
-    merged_data = pd.merge(merged_data, d_icd_diagnoses, on=['icd_code', 'icd_version'], how='inner')
-    merged_data.rename(columns={'hospital_expire_flag': 'label', 'long_title': 'text'}, inplace=True)
 
     # Feature Engineering
-    categories = ['Short', 'Medium', 'Long']
     short_threshold = 2.0
     medium_threshold = 5.0
-
-    # Categorize Length of Stay (LOS)
-    merged_data['LOS_Category'] = pd.cut(merged_data['los'], bins=[0, short_threshold, medium_threshold, float('inf')],
-                                         labels=categories, right=False)
-
-    # Drop unnecessary columns
     columns_to_drop = ['deathtime', 'admit_provider_id', 'dod', 'los', 'language', 'seq_num', 'insurance']
-    merged_data = merged_data.drop(columns=columns_to_drop)
 
-    # Handling missing values
-    merged_data.dropna(inplace=True)
+    # Merge, categorize and clean the datasets, reusing the cached cohort while nothing above changes
+    with profile_phase('load_data') as phase:
+        merged_data = load_cohort(folder_path, clean_text=True, words_to_remove=WORDS_TO_REMOVE,
+                                  short_threshold=short_threshold, medium_threshold=medium_threshold,
+                                  columns_to_drop=columns_to_drop)
+        phase['samples'] = len(merged_data)
 
     return merged_data
 
 
+# Row-wise reference for normalize_titles(titles, WORDS_TO_REMOVE) as used by load_data above
 def preprocess_text(text):
 
-    # Define words to remove (converted to lowercase)
-    words_to_remove = ['and', 'or', 'unspecified', 'other']
     # Remove punctuation using regex
     text = re.sub(r'[^\w\s,]', '', text)
     # Remove commas
     text = text.replace(',', '')
     # Remove specified words (case insensitive)
-    text = ' '.join(word for word in text.split() if word.lower() not in words_to_remove)
+    text = ' '.join(word for word in text.split() if word.lower() not in WORDS_TO_REMOVE)
     return text
 
 
-def create_data_analysis_charts(data):
+def chart_aggregates(data, top_n=8, sample_rows=CORRELATION_SAMPLE_ROWS, seed=42):
+    # Everything the charts draw, computed once from the cohort: small count tables for the bar charts
+    # and the correlation matrix of a uniform row sample with the categorical columns encoded as codes
+    aggregates = {}
+    aggregates['length_of_stay'] = data.groupby(['LOS_Category', 'gender'], observed=True).size().rename('count').reset_index()
 
-    # Plot countplot
-    ax = sns.countplot(data=data, x='LOS_Category', hue='gender')
+    admission_counts = data.groupby(['admission_type', 'anchor_year_group'], observed=True).size().rename('count')
+    top_types = admission_counts.groupby(level='admission_type', observed=True).sum().nlargest(6).index
+    aggregates['admission_type'] = admission_counts[admission_counts.index.get_level_values('admission_type').isin(top_types)].reset_index()
+    aggregates['admission_type_order'] = list(top_types)
+
+    # Count diagnoses case-insensitively by lowercasing the distinct titles only
+    title_counts = data['text'].value_counts()
+    aggregates['diagnoses'] = title_counts.groupby(title_counts.index.str.lower()).sum().nlargest(top_n)
+
+    aggregates['mortality'] = data.groupby(['anchor_year_group', 'label'], observed=True).size().rename('count').reset_index()
+
+    # The sample holds every row of small cohorts; codes are assigned in sorted order like LabelEncoder
+    sample = data.sample(n=sample_rows, random_state=seed) if len(data) > sample_rows else data
+    categorical_columns = ['admission_type', 'icd_code', 'marital_status', 'ETHNICITY', 'LOS_Category', 'gender',
+                           'anchor_year_group', 'label', 'text']
+    numeric_data = sample.select_dtypes(include=[np.number])
+    for col in categorical_columns:
+        if col in sample:
+            numeric_data[col] = pd.factorize(sample[col].astype(str) if sample[col].dtype == 'category' else sample[col],
+                                             sort=True)[0]
+    aggregates['correlation'] = numeric_data.corr()
+    return aggregates
+
+def draw_length_of_stay(aggregates):
+    ax = sns.barplot(data=aggregates['length_of_stay'], x='LOS_Category', y='count', hue='gender', errorbar=None)
     ax.set_title('Length of Stay')
     ax.set_xlabel('Length of Stay Category')
     ax.set_ylabel('Count')
-    # Adjust layout and display the plot
-    plt.tight_layout()
-    plt.show()
 
-    # Plot for the top 6 admission types
+def draw_admission_types(aggregates):
+    # The top 6 admission types
     plt.figure(figsize=(10, 6))
-    sns.countplot(data=data, x='admission_type', order=data['admission_type'].value_counts().index[:6],  hue='anchor_year_group')
+    sns.barplot(data=aggregates['admission_type'], x='admission_type', y='count', hue='anchor_year_group',
+                order=aggregates['admission_type_order'], errorbar=None)
     plt.title('Type of Admission ')
     plt.xlabel('Admission Type')
     plt.ylabel('Count')
     plt.xticks(rotation=45)
-    plt.show()
-
-    top_n = 8
-    # Convert all diagnoses to lowercase to ensure case-insensitive comparison
-    data['text'] = data['text'].str.lower()
-    # Get the top N most frequent diagnoses after removing duplicates
-    top_diagnoses = data['text'].value_counts().nlargest(top_n)
-    # Plot the horizontal bar chart
+
+def draw_top_diagnoses(aggregates):
+    top_diagnoses = aggregates['diagnoses']
     plt.figure(figsize=(10, 6))
     sns.barplot(x=top_diagnoses.values, y=top_diagnoses.index, palette='viridis')
-    plt.title(f'Top {top_n} Most Frequent Diagnoses')
+    plt.title(f'Top {len(top_diagnoses)} Most Frequent Diagnoses')
     plt.xlabel('Count')
     plt.ylabel('Diagnosis')
-    plt.show()
 
+def draw_mortality(aggregates):
     # Map original label values to custom labels
     label_mapping = {1: 'Deceased', 0: 'Survived'}
     # Set custom colors for each label
     custom_palette = {1: 'green', 0: 'red'}
-    # Plot countplot
-    ax = sns.countplot(data=data, x='anchor_year_group', hue='label', palette=custom_palette, hue_order=[1, 0])
+    mortality = aggregates['mortality']
+    ax = sns.barplot(data=mortality, x='anchor_year_group', y='count', hue='label', palette=custom_palette,
+                     hue_order=[1, 0], errorbar=None)
     ax.set_title('Hospital Mortality by Patient Year Group')
     ax.set_xlabel('Patient Year Group')
     ax.set_ylabel('Count')
     # Set custom labels for hue variable
-    legend_labels = [label_mapping[label] for label in sorted(data['label'].unique())]
-    # Set custom colors for legend
-    legend_colors = [custom_palette[label] for label in sorted(data['label'].unique())]
+    legend_labels = [label_mapping[label] for label in sorted(mortality['label'].unique())]
     ax.legend(title='Outcome', labels=legend_labels, loc='upper right', fontsize='small', facecolor='lightgrey', edgecolor='black', fancybox=True, shadow=True)
-    # Adjust layout and display the plot
-    plt.tight_layout()
-    plt.show()
 
-    # Encode categorical variables
-    encoder = LabelEncoder()
-    categorical_columns = ['admission_type','icd_code', 'marital_status', 'ETHNICITY', 'LOS_Category', 'gender', 'anchor_year_group','label','text']
+def draw_correlation(aggregates):
     plt.figure(figsize=(10, 8))
-    # Exclude non-numeric columns from the correlation matrix
-    numeric_data = data.select_dtypes(include=[np.number])
-    for col in categorical_columns:
-        numeric_data[col] = encoder.fit_transform(data[col])
-    sns.heatmap(numeric_data.corr(), annot=True, cmap='coolwarm', fmt=".2f")
+    sns.heatmap(aggregates['correlation'], annot=True, cmap='coolwarm', fmt=".2f")
     plt.title('Correlation Matrix')
-    plt.show()
+
+def render_chart(draw, aggregates, path):
+    # Draw one chart in a pool worker with the non-interactive backend and write it to path
+    plt.switch_backend('Agg')
+    draw(aggregates)
+    plt.tight_layout()
+    plt.savefig(path, dpi=100)
+    plt.close('all')
+    return path
+
+def create_data_analysis_charts(data, chart_dir=CHART_DIR, workers=CHART_WORKERS):
+    # Aggregate the cohort once, then render the charts to PNG files in parallel, without blocking on a display
+    start = time.perf_counter()
+    aggregates = chart_aggregates(data)
+    charts = {'length_of_stay': draw_length_of_stay, 'admission_types': draw_admission_types,
+              'top_diagnoses': draw_top_diagnoses, 'mortality': draw_mortality, 'correlation': draw_correlation}
+    os.makedirs(chart_dir, exist_ok=True)
+    context = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(charts)), mp_context=context) as pool:
+        futures = [pool.submit(render_chart, draw, aggregates, os.path.join(chart_dir, name + '.png'))
+                   for name, draw in charts.items()]
+        paths = [future.result() for future in futures]
+    print("Rendered {} charts to {} in {:.1f}s".format(len(paths), chart_dir, time.perf_counter() - start))
+    return paths
 
 
 # Load data
 merged_df = load_data()
+
+# Compare row-wise and vectorized title normalization on the full d_icd_diagnoses table
+if RUN_BENCHMARKS:
+    benchmark_preprocess_text(load_table('/content/drive/My Drive/Hs/', 'd_icd_diagnoses')['long_title'],
+                              preprocess_text, WORDS_TO_REMOVE)
+
 # Create data analysis charts
 create_data_analysis_charts(merged_df)
 
@@ -430,7 +2454,7 @@ from google.colab import drive
 import pandas as pd
 import numpy as np
 import torch
-from transformers import BertTokenizer, AdamW, BertForSequenceClassification
+from transformers import BertTokenizerFast, AdamW, BertForSequenceClassification
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 from sklearn.model_selection import train_test_split
 from sklearn.base import BaseEstimator, ClassifierMixin
@@ -448,104 +2472,14 @@ def load_data():
     # Load the DataFrames
     folder_path = '/content/drive/My Drive/Hs/'
 
-    # Load the datasets
-    admissions = pd.read_csv(folder_path +'admissions.csv')
-    patients = pd.read_csv(folder_path +'patients.csv')
-    icustays = pd.read_csv(folder_path + 'icustays.csv')
-    diagnoses_icd = pd.read_csv(folder_path + 'diagnoses_icd.csv')
-    d_icd_diagnoses = pd.read_csv(folder_path + 'd_icd_diagnoses.csv')
-
-    # Merge datasets based on common columns using inner join
-    merged_data = pd.merge(admissions, patients, on='subject_id', how='inner')
-    merged_data = pd.merge(merged_data, icustays, on=['subject_id', 'hadm_id'], how='inner')
-    merged_data = pd.merge(merged_data, diagnoses_icd, on=['subject_id', 'hadm_id'], how='inner')
-    merged_data = pd.merge(merged_data, d_icd_diagnoses, on=['icd_code', 'icd_version'], how='inner')
-    merged_data.rename(columns={'hospital_expire_flag': 'label', 'long_title': 'text'}, inplace=True)
-    merged_data.dropna(inplace=True)
+    # Load and merge the datasets, reusing the cached cohort while the source files are unchanged
+    with profile_phase('load_data') as phase:
+        merged_data = load_cohort(folder_path)
+        phase['samples'] = len(merged_data)
     print(merged_data.isnull().sum())
     merged_data = merged_data.sample(100, random_state=42)
     return merged_data
 
-# Custom BERT Classifier
-class MedBERTClassifier(BaseEstimator, ClassifierMixin):
-    def __init__(self, model_name='microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract', lr=2e-5, epochs=3, batch_size=32, early_stopping=True, patience=3):
-        self.model_name = model_name
-        self.lr = lr
-        self.epochs = epochs
-        self.batch_size = batch_size
-        self.early_stopping = early_stopping
-        self.patience = patience
-
-    def fit(self, X, y):
-        self.model = BertForSequenceClassification.from_pretrained(self.model_name, num_labels=2)
-        self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
-        self.optimizer = AdamW(self.model.parameters(), lr=self.lr)
-        best_val_loss = float('inf')
-        patience_counter = 0
-
-        # Tokenize text data and prepare input tensors
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-        labels = torch.tensor(y.tolist())
-
-        # Train the model
-        for epoch in range(self.epochs):
-            self.model.train()
-            running_loss = 0.0
-            for i in range(0, len(labels), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                label_batch = labels[i:i+self.batch_size]
-
-                self.optimizer.zero_grad()
-                outputs = self.model(**input_batch, labels=label_batch)
-                loss = outputs.loss
-                loss.backward()
-                self.optimizer.step()
-
-                running_loss += loss.item()
-
-            # Early stopping
-            if self.early_stopping:
-                val_loss = self.evaluate_loss(X_val, y_val)
-                if val_loss < best_val_loss:
-                    best_val_loss = val_loss
-                    patience_counter = 0
-                else:
-                    patience_counter += 1
-                    if patience_counter >= self.patience:
-                        print("Early stopping after {} epochs.".format(epoch + 1))
-                        break
-
-    def predict(self, X):
-        # Tokenize text data and prepare input tensors
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-
-        # Evaluate the model
-        self.model.eval()
-        predictions = []
-        with torch.no_grad():
-            for i in range(0, len(inputs['input_ids']), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                outputs = self.model(**input_batch)
-                logits = outputs.logits
-                predictions.extend(logits.argmax(dim=1).cpu().tolist())
-        return predictions
-
-    def evaluate_loss(self, X, y):
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-        labels = torch.tensor(y.tolist())
-
-        self.model.eval()
-        total_loss = 0.0
-        with torch.no_grad():
-            for i in range(0, len(labels), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                label_batch = labels[i:i+self.batch_size]
-                outputs = self.model(**input_batch, labels=label_batch)
-                loss = outputs.loss
-                total_loss += loss.item()
-
-        return total_loss / (len(labels) / self.batch_size)
-
 # Define objective function for Optuna
 def objective(trial):
     # Define parameters to search
@@ -554,19 +2488,26 @@ def objective(trial):
     batch_size = trial.suggest_categorical('batch_size', [16, 32, 64])
 
     # Initialize MedBERT Classifier with dynamically passed values
-    med_bert_classifier = MedBERTClassifier(
-        model_name='microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract',
+    med_bert_classifier = BERTClassifier(
+        model_name=BACKBONES['medbert'],
         lr=lr,
         epochs=epochs,
-        batch_size=batch_size
+        batch_size=batch_size,
+        trainable_layers=SEARCH_TRAINABLE_LAYERS,
+        deduplicate=SEARCH_DEDUPLICATE,
+        precision=TRAIN_PRECISION,
+        accumulation_steps=ACCUMULATION_STEPS
     )
 
     # Train the model
-    med_bert_classifier.fit(X_train, y_train)
+    med_bert_classifier.fit(X_train, y_train, X_val, y_val, trial=trial)
 
     # Evaluate using validation set
     predictions = med_bert_classifier.predict(X_val)
     accuracy = accuracy_score(y_val, predictions)
+
+    # Keep the trial's weights for warm-starting the final fit
+    save_trial_checkpoint(trial, med_bert_classifier.model, accuracy)
     return accuracy
 
 # Load data
@@ -575,12 +2516,27 @@ merged_df = load_data()
 # Split data into train, validation, and test sets
 X = merged_df.drop(columns=["label"])
 y = merged_df["label"]
-X_train_val, X_test, y_train_val, y_test = train_test_split(X, y, test_size=0.1, random_state=42)
-X_train, X_val, y_train, y_val = train_test_split(X_train_val, y_train_val, test_size=0.111, random_state=42)  # 80% train, 10% validation, 10% test
+splits = split_frames(X, y, grouped_split(merged_df))  # 80% train, 10% validation, 10% test, by patient
+X_train_val, y_train_val = splits['train_val']
+X_train, y_train = splits['train']
+X_val, y_val = splits['val']
+X_test, y_test = splits['test']
+
+# Compare fixed-order and length-bucketed batching on one training epoch
+if RUN_BENCHMARKS:
+    benchmark_batching(BERTClassifier(model_name=BACKBONES['medbert']), X_train, y_train)
 
-# Run hyperparameter optimization
-study = optuna.create_study(direction='maximize')
-study.optimize(objective, n_trials=100)
+# Check bf16 and gradient-accumulated losses against fp32, then compare their speed and memory
+if RUN_BENCHMARKS:
+    check_training_parity(BACKBONES['medbert'], X_train, y_train)
+    benchmark_precision(BERTClassifier(model_name=BACKBONES['medbert']), X_train, y_train)
+
+# Compare all registered backbones through the same classifier pipeline
+if RUN_BENCHMARKS:
+    benchmark_backbones(X_train, y_train, X_val, y_val)
+
+# Run (or resume) hyperparameter optimization
+study = run_study(objective, 'medbert', n_trials=100)
 
 # Print best parameters and performance
 print("Best parameters found: ", study.best_params)
@@ -589,19 +2545,35 @@ print("Best accuracy on validation set: {:.4f}".format(study.best_value))
 # Get the best model parameters
 best_params = study.best_params
 
-# Train the best model on the entire training and validation data
-best_model = MedBERTClassifier(
-    model_name='microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract',
+# Train the best model on the entire training and validation data, continuing from the best trial's
+# checkpoint when it was kept
+warm_start = best_trial_checkpoint(study)
+best_model = BERTClassifier(
+    model_name=BACKBONES['medbert'],
     lr=best_params['lr'],
-    epochs=best_params['epochs'],
-    batch_size=best_params['batch_size']
+    epochs=WARM_START_EPOCHS if warm_start else best_params['epochs'],
+    batch_size=best_params['batch_size'],
+    warm_start=warm_start,
+    deduplicate=SEARCH_DEDUPLICATE,
+    precision=TRAIN_PRECISION,
+    accumulation_steps=ACCUMULATION_STEPS
 )
 best_model.fit(X_train_val, y_train_val)
 
-# Save the best model to a pkl file
-model_filename = "BiomedNLP-PubMedBERT-base-uncased_Model.pkl"  # You can choose a different filename
-dump(best_model, model_filename)
-print(f"Best model saved to {model_filename}")
+# Save the best model as safetensors weights, tokenizer files and a JSON manifest
+model_dir = "BiomedNLP-PubMedBERT-base-uncased_Model"  # You can choose a different directory
+save_classifier(best_model, model_dir)
+print(f"Best model saved to {model_dir}")
+
+# Compare cold-start loading of the artifact with a joblib pickle of the estimator
+if RUN_BENCHMARKS:
+    benchmark_artifact_loading(best_model, model_dir, X_test["text"])
+
+# Serve the best model locally and drive it with concurrent single-text requests
+if RUN_BENCHMARKS:
+    server = PredictionServer(best_model, port=0).start()
+    run_load_test(server.host, server.port, X_test["text"])
+    server.stop()
 
 # Evaluate the best model on the test set
 test_predictions = best_model.predict(X_test)
@@ -614,12 +2586,18 @@ print("Accuracy on test set: {:.4f}".format(test_accuracy))
 print("Precision on test set: {:.4f}".format(test_precision))
 print("Recall on test set: {:.4f}".format(test_recall))
 print("F1-score on test set: {:.4f}".format(test_f1))
+print("Scored {rows} test rows at {rows_per_sec:.0f} rows/sec, {batch_latency_p50_ms:.1f} ms per batch (median)".format(
+    **best_model.predict_stats_))
+
+# Export int8 TorchScript and ONNX versions for CPU serving and check them against the fp32 model
+export_paths = export_model(best_model.model, best_model.tokenizer, os.path.join(model_dir, 'model'), X_train["text"])
+compare_exports(best_model.model, best_model.tokenizer, best_model.model_name, export_paths, X_test, y_test)
 
 from google.colab import drive
 import pandas as pd
 import numpy as np
 import torch
-from transformers import BertTokenizer, AdamW, BertForSequenceClassification
+from transformers import BertTokenizerFast, AdamW, BertForSequenceClassification
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 from sklearn.model_selection import train_test_split
 from sklearn.base import BaseEstimator, ClassifierMixin
@@ -637,104 +2615,14 @@ def load_data():
     # Load the DataFrames
     folder_path = '/content/drive/My Drive/Hs/'
 
-    # Load the datasets
-    admissions = pd.read_csv(folder_path +'admissions.csv')
-    patients = pd.read_csv(folder_path +'patients.csv')
-    icustays = pd.read_csv(folder_path + 'icustays.csv')
-    diagnoses_icd = pd.read_csv(folder_path + 'diagnoses_icd.csv')
-    d_icd_diagnoses = pd.read_csv(folder_path + 'd_icd_diagnoses.csv')
-
-    # Merge datasets based on common columns using inner join
-    merged_data = pd.merge(admissions, patients, on='subject_id', how='inner')
-    merged_data = pd.merge(merged_data, icustays, on=['subject_id', 'hadm_id'], how='inner')
-    merged_data = pd.merge(merged_data, diagnoses_icd, on=['subject_id', 'hadm_id'], how='inner')
-    merged_data = pd.merge(merged_data, d_icd_diagnoses, on=['icd_code', 'icd_version'], how='inner')
-    merged_data.rename(columns={'hospital_expire_flag': 'label', 'long_title': 'text'}, inplace=True)
-    merged_data.dropna(inplace=True)
+    # Load and merge the datasets, reusing the cached cohort while the source files are unchanged
+    with profile_phase('load_data') as phase:
+        merged_data = load_cohort(folder_path)
+        phase['samples'] = len(merged_data)
     print(merged_data.isnull().sum())
     merged_data = merged_data.sample(100, random_state=42)
     return merged_data
 
-# Custom BERT Classifier
-class BioBERTClassifier(BaseEstimator, ClassifierMixin):
-    def __init__(self, model_name='dmis-lab/biobert-v1.1', lr=2e-5, epochs=3, batch_size=32, early_stopping=True, patience=3):
-        self.model_name = model_name
-        self.lr = lr
-        self.epochs = epochs
-        self.batch_size = batch_size
-        self.early_stopping = early_stopping
-        self.patience = patience
-
-    def fit(self, X, y):
-        self.model = BertForSequenceClassification.from_pretrained(self.model_name, num_labels=2)
-        self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
-        self.optimizer = AdamW(self.model.parameters(), lr=self.lr)
-        best_val_loss = float('inf')
-        patience_counter = 0
-
-        # Tokenize text data and prepare input tensors
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-        labels = torch.tensor(y.tolist())
-
-        # Train the model
-        for epoch in range(self.epochs):
-            self.model.train()
-            running_loss = 0.0
-            for i in range(0, len(labels), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                label_batch = labels[i:i+self.batch_size]
-
-                self.optimizer.zero_grad()
-                outputs = self.model(**input_batch, labels=label_batch)
-                loss = outputs.loss
-                loss.backward()
-                self.optimizer.step()
-
-                running_loss += loss.item()
-
-            # Early stopping
-            if self.early_stopping:
-                val_loss = self.evaluate_loss(X_val, y_val)
-                if val_loss < best_val_loss:
-                    best_val_loss = val_loss
-                    patience_counter = 0
-                else:
-                    patience_counter += 1
-                    if patience_counter >= self.patience:
-                        print("Early stopping after {} epochs.".format(epoch + 1))
-                        break
-
-    def predict(self, X):
-        # Tokenize text data and prepare input tensors
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-
-        # Evaluate the model
-        self.model.eval()
-        predictions = []
-        with torch.no_grad():
-            for i in range(0, len(inputs['input_ids']), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                outputs = self.model(**input_batch)
-                logits = outputs.logits
-                predictions.extend(logits.argmax(dim=1).cpu().tolist())
-        return predictions
-
-    def evaluate_loss(self, X, y):
-        inputs = self.tokenizer(X["text"].tolist(), padding=True, truncation=True, return_tensors='pt', max_length=128)
-        labels = torch.tensor(y.tolist())
-
-        self.model.eval()
-        total_loss = 0.0
-        with torch.no_grad():
-            for i in range(0, len(labels), self.batch_size):
-                input_batch = {k: v[i:i+self.batch_size] for k, v in inputs.items()}
-                label_batch = labels[i:i+self.batch_size]
-                outputs = self.model(**input_batch, labels=label_batch)
-                loss = outputs.loss
-                total_loss += loss.item()
-
-        return total_loss / (len(labels) / self.batch_size)
-
 # Define objective function for Optuna
 def objective(trial):
     # Define parameters to search
@@ -743,19 +2631,26 @@ def objective(trial):
     batch_size = trial.suggest_categorical('batch_size', [16, 32, 64])
 
     # Initialize BioBERT Classifier with dynamically passed values
-    bio_bert_classifier = BioBERTClassifier(
-        model_name='dmis-lab/biobert-v1.1',
+    bio_bert_classifier = BERTClassifier(
+        model_name=BACKBONES['biobert'],
         lr=lr,
         epochs=epochs,
-        batch_size=batch_size
+        batch_size=batch_size,
+        trainable_layers=SEARCH_TRAINABLE_LAYERS,
+        deduplicate=SEARCH_DEDUPLICATE,
+        precision=TRAIN_PRECISION,
+        accumulation_steps=ACCUMULATION_STEPS
     )
 
     # Train the model
-    bio_bert_classifier.fit(X_train, y_train)
+    bio_bert_classifier.fit(X_train, y_train, X_val, y_val, trial=trial)
 
     # Evaluate using validation set
     predictions = bio_bert_classifier.predict(X_val)
     accuracy = accuracy_score(y_val, predictions)
+
+    # Keep the trial's weights for warm-starting the final fit
+    save_trial_checkpoint(trial, bio_bert_classifier.model, accuracy)
     return accuracy
 
 # Load data
@@ -764,12 +2659,14 @@ merged_df = load_data()
 # Split data into train, validation, and test sets
 X = merged_df.drop(columns=["label"])
 y = merged_df["label"]
-X_train_val, X_test, y_train_val, y_test = train_test_split(X, y, test_size=0.1, random_state=42)
-X_train, X_val, y_train, y_val = train_test_split(X_train_val, y_train_val, test_size=0.111, random_state=42)  # 80% train, 10% validation, 10% test
+splits = split_frames(X, y, grouped_split(merged_df))  # 80% train, 10% validation, 10% test, by patient
+X_train_val, y_train_val = splits['train_val']
+X_train, y_train = splits['train']
+X_val, y_val = splits['val']
+X_test, y_test = splits['test']
 
-# Run hyperparameter optimization
-study = optuna.create_study(direction='maximize')
-study.optimize(objective, n_trials=100)
+# Run (or resume) hyperparameter optimization
+study = run_study(objective, 'biobert', n_trials=100)
 
 # Print best parameters and performance
 print("Best parameters found: ", study.best_params)
@@ -778,19 +2675,35 @@ print("Best accuracy on validation set: {:.4f}".format(study.best_value))
 # Get the best model parameters
 best_params = study.best_params
 
-# Train the best model on the entire training and validation data
-best_model = BioBERTClassifier(
-    model_name='dmis-lab/biobert-v1.1',
+# Train the best model on the entire training and validation data, continuing from the best trial's
+# checkpoint when it was kept
+warm_start = best_trial_checkpoint(study)
+best_model = BERTClassifier(
+    model_name=BACKBONES['biobert'],
     lr=best_params['lr'],
-    epochs=best_params['epochs'],
-    batch_size=best_params['batch_size']
+    epochs=WARM_START_EPOCHS if warm_start else best_params['epochs'],
+    batch_size=best_params['batch_size'],
+    warm_start=warm_start,
+    deduplicate=SEARCH_DEDUPLICATE,
+    precision=TRAIN_PRECISION,
+    accumulation_steps=ACCUMULATION_STEPS
 )
 best_model.fit(X_train_val, y_train_val)
 
-# Save the best model to a pkl file
-model_filename = "Biobert-base-uncased_Model.pkl"  # You can choose a different filename
-dump(best_model, model_filename)
-print(f"Best model saved to {model_filename}")
+# Save the best model as safetensors weights, tokenizer files and a JSON manifest
+model_dir = "Biobert-base-uncased_Model"  # You can choose a different directory
+save_classifier(best_model, model_dir)
+print(f"Best model saved to {model_dir}")
+
+# Compare cold-start loading of the artifact with a joblib pickle of the estimator
+if RUN_BENCHMARKS:
+    benchmark_artifact_loading(best_model, model_dir, X_test["text"])
+
+# Serve the best model locally and drive it with concurrent single-text requests
+if RUN_BENCHMARKS:
+    server = PredictionServer(best_model, port=0).start()
+    run_load_test(server.host, server.port, X_test["text"])
+    server.stop()
 
 # Evaluate the best model on the test set
 test_predictions = best_model.predict(X_test)
@@ -803,4 +2716,10 @@ print("Accuracy on test set: {:.4f}".format(test_accuracy))
 print("Precision on test set: {:.4f}".format(test_precision))
 print("Recall on test set: {:.4f}".format(test_recall))
 print("F1-score on test set: {:.4f}".format(test_f1))
+print("Scored {rows} test rows at {rows_per_sec:.0f} rows/sec, {batch_latency_p50_ms:.1f} ms per batch (median)".format(
+    **best_model.predict_stats_))
+
+# Export int8 TorchScript and ONNX versions for CPU serving and check them against the fp32 model
+export_paths = export_model(best_model.model, best_model.tokenizer, os.path.join(model_dir, 'model'), X_train["text"])
+compare_exports(best_model.model, best_model.tokenizer, best_model.model_name, export_paths, X_test, y_test)
 